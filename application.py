@@ -1,13 +1,16 @@
 #!/usr/bin/python
 
 from sys import argv, exit
+import argparse
 import threading
 import time
 import helper
 import signal
 import os
-from paxos.node import Node
+import random
+from paxos.shard import ShardedNode
 from paxos.log import Log
+from paxos.logger import Logger
 
 
 def signal_handler(sig, frame):
@@ -17,35 +20,79 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
-# Threading event for when our proposal is accepted
+# Seconds to wait for a linearizable read before giving up on it
+READ_TIMEOUT = 5
+
+# Run query(log) on the log of node once it holds every operation decided so far, and
+# return its result, or None if that took too long
+def read(node, query):
+    result = node.read(query)
+    if not result.wait(READ_TIMEOUT):
+        print 'Could not reach a quorum to read from'
+        return None
+    return result.value
+
+# Threading event which is set while the node can take another proposal
 proposalCompleted = threading.Event()
 proposalCompleted.set()
 
 # Get the arguments
-if len(argv) == 5:
-    node = Node(argv[1], int(argv[2]), argv[3], int(argv[4]), proposalCompleted = proposalCompleted)
-elif len(argv) == 6:
-    node = Node(argv[1], int(argv[2]), argv[3], int(argv[4]), config = argv[5], proposalCompleted = proposalCompleted)
-
-else:
-    print ''
-    print 'Usage: {0} <local ip> <local port> <global ip> <global port> [config]'.format(str(argv[0]))
-    print ''
-    exit(0)
-
-# Create Node object
-node.daemon = True
-node.start()
+parser = argparse.ArgumentParser(usage = '{0} <local ip> <local port> <global ip> <global port> [config]'.format(str(argv[0])))
+parser.add_argument('localIP')
+parser.add_argument('localPort', type = int)
+parser.add_argument('globalIP')
+parser.add_argument('globalPort', type = int)
+parser.add_argument('config', nargs = '?', default = 'config')
+parser.add_argument('--window', type = int, default = 1, 
+                    help = 'number of proposals this node keeps in flight at once')
+parser.add_argument('--batch-size', type = int, default = 1, 
+                    help = 'maximum number of operations proposed together in one round')
+parser.add_argument('--batch-delay', type = int, default = 10, 
+                    help = 'milliseconds an operation may wait for its batch to fill up')
+parser.add_argument('--flush-interval', type = int, default = 2, 
+                    help = 'milliseconds decisions may wait to share an fsync of the log')
+parser.add_argument('--flush-batch', type = int, default = 256, 
+                    help = 'maximum number of decisions written with a single fsync')
+parser.add_argument('--snapshot-interval', type = int, default = 1000, 
+                    help = 'number of rounds between snapshots of the log')
+parser.add_argument('--anti-entropy', type = float, default = 5, 
+                    help = 'seconds between comparing the log with a random peer, 0 to disable')
+parser.add_argument('--log-level', type = Logger.getLevel, default = 'info', 
+                    help = 'least severe level logged: trace (every message), debug, info, warning or error')
+parser.add_argument('--stats-port', type = int, default = None, 
+                    help = 'local UDP port answering every datagram with the node\'s metrics as JSON')
+parser.add_argument('--tcp', action = 'store_true', 
+                    help = 'send messages over persistent TCP connections to the peers instead of UDP')
+parser.add_argument('--shards', type = int, default = 1, 
+                    help = 'number of shards the accounts are split into, each with Paxos rounds and a log of its own')
+parser.add_argument('--thrifty', action = 'store_true', 
+                    help = 'send each phase of a proposal to a quorum only, asking the other peers if it fails')
+parser.add_argument('--allow-pickle', action = 'store_true', 
+                    help = 'accept pickled messages of nodes running an older version, only while upgrading them')
+options = parser.parse_args()
+
+server = ShardedNode(options.shards, options.localIP, options.localPort, options.globalIP, options.globalPort, 
+                     config = options.config, proposalCompleted = proposalCompleted, stableLeader = True, 
+                     window = options.window, batchSize = options.batch_size, batchDelay = options.batch_delay, 
+                     flushInterval = options.flush_interval, flushBatch = options.flush_batch, 
+                     snapshotInterval = options.snapshot_interval, antiEntropyInterval = options.anti_entropy, 
+                     logLevel = options.log_level, statsPort = options.stats_port, tcp = options.tcp,
+                     thrifty = options.thrifty, allowPickle = options.allow_pickle)
+
+# Start the node. The balance without an account is kept by the first shard
+server.daemon = True
+server.start()
+node = server.shardFor(None)
 
 # Wait a moment for the node to get its socket set up
 time.sleep(1)
 
 # Sync when you start
-# node.logSync(node.log.transactions)
+# node.logSync()
 
 # Main loop of application
 while True:
-    # Wait for the current proposal to finish
+    # Wait until the node has room for another proposal
     proposalCompleted.wait()
     
     # Get user input
@@ -57,20 +104,26 @@ while True:
     
     if input == 'help':
         print '\n------------------------------------------------\n'
-        print '(b)alance'
-        print '  - Returns the current balance\n'
+        print '(b)alance [<round>]'
+        print '  - Returns the current balance, or the balance after <round>\n'
         print '(d)eposit <amount>'
         print '  - Increments the current balance by <amount>\n'
         print '(w)ithdraw <amount>'
         print '  - Decrements the current balance by <amount>\n'
+        print '(a)ccount <account>'
+        print '  - Returns the balance of <account>\n'
+        print '(d)eposit <amount> <account>, (w)ithdraw <amount> <account>'
+        print '  - Changes the balance of <account> by <amount>\n'
         print '(s)ync'
         print '  - Synchronizes the node log with the logs of the other servers\n'
         print '(f)ail'
         print '  - Simulates a node failure\n'
         print '(u)nfail'
         print '  - Starts node after fail was called\n'
-        print '(p)rint'
-        print '  - Prints the contents of the transaction log'
+        print '(p)rint [<from> <to>]'
+        print '  - Prints the contents of the transaction log, or only rounds <from> to <to>\n'
+        print 'stats'
+        print '  - Prints phase latencies, message counts and queue depths of the node'
         print '------------------------------------------------'
         continue
 
@@ -82,41 +135,77 @@ while True:
         args[0] = args[0].lower()
         
         if args[0] == 'b' or args[0] == 'balance':
-            print 'Balance: ', node.log.balance
+            balance = read(node, lambda log: log.balance)
+            if balance != None:
+                print 'Balance: ', balance
 
         elif args[0] == 'f' or args[0] == 'fail':
-            node.fail()
+            server.loop.callSoon(server.fail)
                 
         elif args[0] == 'u' or args[0] == 'unfail':
-            node.unfail()
+            server.loop.callSoon(server.unfail)
             
         elif args[0] == 'p' or args[0] == 'print':
-            node.log.history()
+            node.read(lambda log: log.history())
                 
         elif args[0] == 's' or args[0] == 'sync':
-            node.logSync(node.log.transactions)
+            server.loop.callSoon(server.logSync)
+        
+        elif args[0] == 'stats':
+            server.loop.callSoon(server.printStats)
                 
+    elif len(args) == 2 and args[0].lower() in ('a', 'account'):
+        account = args[1]
+        balance = read(server.shardFor(account), lambda log: log.getAccountBalance(account))
+        if balance != None:
+            print 'Balance of {0}: '.format(account), balance
+    
     elif len(args) == 2:
         args[0] = args[0].lower()
         
         # Make sure second arg is a numerical value
         if helper.isNumber(args[1]):
             amount = float(args[1])
-            h = hash((args[0], amount, node.addr, int(time.time())))
+            h = random.getrandbits(63)
             
-            if args[0] == 'd' or args[0] == 'deposit':
-                proposalCompleted.clear()
-                node.initPaxos(value = (Log.DEPOSIT, amount, h))
+            if args[0] == 'b' or args[0] == 'balance':
+                balance = node.log.balanceAt(int(amount))
+                if balance == None:
+                    print 'Round {0} is not applied or already in the snapshot'.format(int(amount))
+                else:
+                    print 'Balance: ', balance
+            
+            elif args[0] == 'd' or args[0] == 'deposit':
+                node.submit((Log.DEPOSIT, amount, h))
             
             elif args[0] == 'w' or args[0] == 'withdraw':
                 if node.log.balance >= amount:
-                    proposalCompleted.clear()
-                    node.initPaxos(value = (Log.WITHDRAW, amount, h))
+                    node.submit((Log.WITHDRAW, amount, h))
                 else: 
                     print 'Not enough funds in your account. Sucker!'
     
         else:
             print 'Invalid amount'
+    
+    elif len(args) == 3:
+        args[0] = args[0].lower()
+        
+        if (args[0] == 'p' or args[0] == 'print') and args[1].isdigit() and args[2].isdigit():
+            lo, hi = int(args[1]), int(args[2])
+            node.read(lambda log: log.history(lo, hi))
+        
+        elif args[0] in ('d', 'deposit', 'w', 'withdraw') and helper.isNumber(args[1]):
+            amount, account = float(args[1]), args[2]
+            h = random.getrandbits(63)
+            
+            if args[0] == 'd' or args[0] == 'deposit':
+                server.submit((Log.DEPOSIT, amount, h, account))
+            
+            elif server.getAccountBalance(account) >= amount:
+                server.submit((Log.WITHDRAW, amount, h, account))
+            
+            else:
+                print 'Not enough funds in account {0}'.format(account)
 
 
 
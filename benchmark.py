@@ -0,0 +1,366 @@
+#!/usr/bin/python
+
+'''
+Starts a cluster of nodes in this process and measures how fast it decides a workload of
+deposits and withdrawals, optionally mixed with linearizable balance reads. Each run appends its settings and results as one JSON line to
+the output file, so that runs can be compared over time.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from paxos.shard import ShardedNode
+from paxos.log import Log
+from paxos.logger import Logger
+from paxos.simulation import SimulatedLoop
+from paxos.simulation import SimulatedNetwork
+from paxos.simulation import SimulatedTransport
+from paxos.simulation import SimulatedCommit
+
+# Get the arguments
+parser = argparse.ArgumentParser(description = 'Benchmark a cluster of Paxos nodes running in this process')
+parser.add_argument('config', nargs = '?', default = 'config',
+                    help = 'configuration file with one ip:port per server')
+parser.add_argument('--nodes', type = int, default = None,
+                    help = 'number of servers from the config to start (default all)')
+parser.add_argument('--proposers', type = int, default = 1,
+                    help = 'number of nodes submitting operations')
+parser.add_argument('--concurrency', type = int, default = 1,
+                    help = 'number of clients per proposer, each waiting on one operation at a time')
+parser.add_argument('--operations', type = int, default = 1000,
+                    help = 'number of operations to submit in total')
+parser.add_argument('--warmup', type = int, default = 10,
+                    help = 'operations decided before measuring, which also elect a leader')
+parser.add_argument('--withdraw-ratio', type = float, default = 0.5,
+                    help = 'fraction of the operations that are withdrawals')
+parser.add_argument('--read-ratio', type = float, default = 0,
+                    help = 'fraction of the operations that are linearizable balance reads')
+parser.add_argument('--window', type = int, default = None,
+                    help = 'proposals each node keeps in flight (default the concurrency)')
+parser.add_argument('--batch-size', type = int, default = 1)
+parser.add_argument('--batch-delay', type = int, default = 10)
+parser.add_argument('--flush-interval', type = int, default = 2)
+parser.add_argument('--flush-batch', type = int, default = 256)
+parser.add_argument('--snapshot-interval', type = int, default = 1000)
+parser.add_argument('--log-level', type = Logger.getLevel, default = 'warning')
+parser.add_argument('--tcp', action = 'store_true',
+                    help = 'send messages over TCP connections instead of UDP')
+parser.add_argument('--shards', type = int, default = 1,
+                    help = 'number of shards per node, each with Paxos rounds and a log of its own')
+parser.add_argument('--thrifty', action = 'store_true',
+                    help = 'send each phase of a proposal to a quorum only')
+parser.add_argument('--accounts', type = int, default = 0,
+                    help = 'number of accounts the operations are spread over (default 0, no accounts, '
+                           'so that every operation goes to the first shard)')
+parser.add_argument('--output', default = 'benchmark.jsonl',
+                    help = 'file to append the results to, - for standard output')
+parser.add_argument('--label', default = None,
+                    help = 'name of the run, stored with its results')
+parser.add_argument('--simulate', action = 'store_true',
+                    help = 'run the nodes on a simulated network under a virtual clock instead of UDP')
+parser.add_argument('--latency', type = float, default = 1,
+                    help = 'milliseconds a simulated message takes')
+parser.add_argument('--jitter', type = float, default = 0,
+                    help = 'milliseconds a simulated message may take more or less than the latency')
+parser.add_argument('--loss', type = float, default = 0,
+                    help = 'fraction of the simulated messages lost')
+parser.add_argument('--reorder', type = float, default = 0,
+                    help = 'fraction of the simulated messages held back so that later ones overtake them')
+parser.add_argument('--seed', type = int, default = 0,
+                    help = 'seed of the simulation, which repeats exactly for the same seed')
+
+# A deposit or withdrawal of a random amount, on one of the given number of accounts if any
+def makeValue(withdrawRatio, accounts):
+    type = Log.WITHDRAW if random.random() < withdrawRatio else Log.DEPOSIT
+    value = (type, float(random.randint(1, 100)), random.getrandbits(63))
+    if accounts:
+        value += ('account-{0}'.format(random.randrange(accounts)),)
+    return value
+
+# Account to read the balance of, one of the given number of accounts if any
+def makeAccount(accounts):
+    return 'account-{0}'.format(random.randrange(accounts)) if accounts else None
+
+# Query of a balance read of account
+def balanceQuery(account):
+    if account == None:
+        return lambda log: log.balance
+    return lambda log: log.getAccountBalance(account)
+
+# Client submitting operations to node one at a time until the shared count runs out.
+# Records the commit latency of every operation, or the latency of every read, in latencies
+def client(node, remaining, lock, latencies, withdrawRatio, readRatio, accounts):
+    while True:
+        with lock:
+            if remaining[0] <= 0:
+                return
+            remaining[0] -= 1
+
+        start = time.time()
+        if random.random() < readRatio:
+            account = makeAccount(accounts)
+            if not node.shardFor(account).read(balanceQuery(account)).wait(60):
+                print >>sys.stderr, 'Read not served within 60 seconds'
+                continue
+        
+        elif not node.submit(makeValue(withdrawRatio, accounts)).wait(60):
+            print >>sys.stderr, 'Operation not decided within 60 seconds'
+            continue
+        latency = time.time() - start
+
+        with lock:
+            latencies.append(latency)
+
+# Value at fraction p of the sorted samples
+def percentile(samples, p):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+# The nodes of every shard of the given servers
+def shardNodes(servers):
+    return [node for server in servers for node in server.nodes]
+
+# Messages sent by all of the nodes so far
+def messagesSent(nodes):
+    total = 0
+    for node in shardNodes(nodes):
+        for name, value in node.metrics.snapshot()['counters'].iteritems():
+            if name.startswith('sent.'):
+                total += value
+    return total
+
+def counter(nodes, name):
+    return sum(node.metrics.snapshot()['counters'].get(name, 0) for node in shardNodes(nodes))
+
+def makeNode(options, ip, port, loop = None, transport = None):
+    return ShardedNode(options.shards, ip, port, ip, port, config = 'config', stableLeader = True,
+                       window = options.window, batchSize = options.batch_size, batchDelay = options.batch_delay,
+                       flushInterval = options.flush_interval, flushBatch = options.flush_batch,
+                       snapshotInterval = options.snapshot_interval, antiEntropyInterval = 0,
+                       logLevel = options.log_level, tcp = options.tcp, thrifty = options.thrifty, loop = loop,
+                       transport = transport)
+
+# Counters of the cluster that the results are the difference of. Rounds are counted
+# in every shard
+def measure(nodes):
+    return {'messages': messagesSent(nodes),
+            'round': sum(max(node.nodes[shard].log.appliedRound for node in nodes)
+                         for shard in xrange(len(nodes[0].nodes))),
+            'nacks': counter(nodes, 'nacks'),
+            'retries': counter(nodes, 'retries'),
+            'leaseReads': counter(nodes, 'reads.lease'),
+            'indexReads': counter(nodes, 'reads.index')}
+
+def summarize(latencies, elapsed, before, after):
+    latencies.sort()
+    decisions = after['round'] - before['round']
+    messages = after['messages'] - before['messages']
+    return {'operations': len(latencies),
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else None,
+            'latency': {'mean': sum(latencies) / len(latencies) if latencies else None,
+                        'p50': percentile(latencies, 0.5),
+                        'p90': percentile(latencies, 0.9),
+                        'p99': percentile(latencies, 0.99),
+                        'max': latencies[-1] if latencies else None},
+            'decisions': decisions,
+            'messages': messages,
+            'messagesPerDecision': float(messages) / decisions if decisions else None,
+            'nacks': after['nacks'] - before['nacks'],
+            'retries': after['retries'] - before['retries'],
+            'leaseReads': after['leaseReads'] - before['leaseReads'],
+            'indexReads': after['indexReads'] - before['indexReads']}
+
+def run(options, servers):
+    nodes = []
+    for ip, port in servers:
+        node = makeNode(options, ip, port)
+        node.daemon = True
+        node.start()
+        nodes.append(node)
+
+    # Wait a moment for the nodes to get their sockets set up
+    time.sleep(0.5)
+    proposers = nodes[:options.proposers]
+
+    # Elect a leader of every shard and warm up before measuring
+    for i in xrange(options.warmup):
+        for shard in proposers[0].nodes:
+            shard.submit((Log.DEPOSIT, 1.0, random.getrandbits(63))).wait(60)
+
+    before = measure(nodes)
+
+    remaining = [options.operations]
+    lock = threading.Lock()
+    latencies = []
+    clients = []
+    for node in proposers:
+        for i in xrange(options.concurrency):
+            clients.append(threading.Thread(target = client,
+                                            args = (node, remaining, lock, latencies, options.withdraw_ratio,
+                                                    options.read_ratio, options.accounts)))
+
+    start = time.time()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - start
+
+    # Let the DECIDEs of the last rounds reach every node before counting
+    time.sleep(0.2)
+    after = measure(nodes)
+
+    for node in nodes:
+        node.loop.stop()
+
+    return summarize(latencies, elapsed, before, after)
+
+class SimulatedClient(object):
+    '''
+    Client of a simulated node, submitting operations on the simulation's loop one at a
+    time until the shared count runs out. The shard of the operation calls set once it is
+    decided, or once it served the read. Without accounts, the client submits to the
+    given shard
+    '''
+
+    def __init__(self, node, remaining, latencies, withdrawRatio, readRatio, accounts, done, shard = 0):
+        self.node = node
+        self.remaining = remaining
+        self.latencies = latencies
+        self.withdrawRatio = withdrawRatio
+        self.readRatio = readRatio
+        self.accounts = accounts
+        self.done = done
+        self.shard = shard
+        self.start = None
+
+    def next(self):
+        if self.remaining[0] <= 0:
+            self.done()
+            return
+        self.remaining[0] -= 1
+        self.start = self.node.loop.time()
+
+        if random.random() < self.readRatio:
+            account = makeAccount(self.accounts)
+            shard = self.node.shardFor(account) if self.accounts else self.node.nodes[self.shard]
+            shard.read(balanceQuery(account), self)
+            return
+
+        value = makeValue(self.withdrawRatio, self.accounts)
+        shard = self.node.shardForValue(value) if self.accounts else self.node.nodes[self.shard]
+        shard.initPaxos(None, value, None, self)
+
+    def set(self):
+        self.latencies.append(self.node.loop.time() - self.start)
+        self.node.loop.callSoon(self.next)
+
+# Run count operations from concurrency clients per proposer on the simulation's loop,
+# giving up after an hour of simulated time. Returns the commit latencies
+def simulate(loop, proposers, count, concurrency, withdrawRatio, readRatio, accounts, shard = 0):
+    remaining = [count]
+    latencies = []
+    active = [len(proposers) * concurrency]
+
+    def done():
+        active[0] -= 1
+        if not active[0]:
+            loop.stop()
+
+    for node in proposers:
+        for i in xrange(concurrency):
+            loop.callSoon(SimulatedClient(node, remaining, latencies, withdrawRatio, readRatio, accounts, done,
+                                          shard).next)
+    loop.run(loop.time() + 3600)
+    return latencies
+
+def runSimulated(options, servers):
+    random.seed(options.seed)
+    loop = SimulatedLoop()
+    network = SimulatedNetwork(loop, options.latency / 1000.0, options.jitter / 1000.0,
+                               options.loss, options.reorder, options.seed)
+
+    nodes = []
+    for ip, port in servers:
+        node = makeNode(options, ip, port, loop, SimulatedTransport(network, (ip, port)))
+        for shard in node.nodes:
+            shard.log.committer = SimulatedCommit(shard.log.wal)
+            shard.log.acceptor.committer = SimulatedCommit(shard.log.acceptor.wal)
+        node.startServices()
+        nodes.append(node)
+    proposers = nodes[:options.proposers]
+
+    for shard in xrange(options.shards):
+        simulate(loop, proposers[:1], options.warmup, 1, options.withdraw_ratio, 0, 0, shard)
+    before = measure(nodes)
+
+    start, wallStart = loop.time(), time.time()
+    latencies = simulate(loop, proposers, options.operations, options.concurrency, options.withdraw_ratio,
+                         options.read_ratio, options.accounts)
+    elapsed = loop.time() - start
+    wallElapsed = time.time() - wallStart
+
+    # Let the DECIDEs of the last rounds reach every node before counting
+    loop.run(loop.time() + 0.2)
+    results = summarize(latencies, elapsed, before, measure(nodes))
+    results['wallElapsed'] = wallElapsed
+    results['delivered'] = network.delivered
+    results['dropped'] = network.dropped
+    return results
+
+if __name__ == '__main__':
+    options = parser.parse_args()
+
+    servers = []
+    for line in open(options.config).read().splitlines():
+        if line.strip():
+            ip, port = line.strip().split(':')
+            servers.append((ip, int(port)))
+    servers = servers[:options.nodes or len(servers)]
+    options.proposers = max(1, min(options.proposers, len(servers)))
+    options.window = options.window or options.concurrency
+
+    output = options.output
+    if output != '-':
+        output = os.path.abspath(output)
+
+    # Nodes keep their logs in the working directory, so every run starts from an empty one
+    directory = tempfile.mkdtemp(prefix = 'paxos-benchmark-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        with open('config', 'w') as file:
+            file.write('\n'.join('{0}:{1}'.format(ip, port) for ip, port in servers))
+        if options.simulate:
+            results = runSimulated(options, servers)
+        else:
+            results = run(options, servers)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors = True)
+
+    settings = dict(vars(options))
+    settings['nodes'] = len(servers)
+    settings['log_level'] = Logger.NAMES[options.log_level].lower()
+    del settings['output']
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'settings': settings, 'results': results}
+
+    if output == '-':
+        print json.dumps(record, sort_keys = True)
+    else:
+        with open(output, 'a') as file:
+            file.write(json.dumps(record, sort_keys = True) + '\n')
+
+    print >>sys.stderr, ('{0} operations in {1:.2f}s: {2:.1f} ops/s, p50 {3:.2f}ms, p99 {4:.2f}ms, '
+                         '{5:.1f} messages per decision, {6} lease reads, {7} read index reads'.format(
+                         results['operations'], results['elapsed'], results['throughput'] or 0,
+                         (results['latency']['p50'] or 0) * 1000, (results['latency']['p99'] or 0) * 1000,
+                         results['messagesPerDecision'] or 0, results['leaseReads'], results['indexReads']))
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import codec
+from wal import WriteAheadLog
+from wal import GroupCommit
+
+class AcceptorLog(object):
+    '''
+    The promises and acceptances this node made as an acceptor, kept in a write-ahead log
+    of their own, so that it keeps its word across a restart. A PROMISE or ACCEPT reply
+    may only go out once the state it reports on is durable, which the callback given
+    with each record tells. Rounds below the snapshot of the log are forgotten as it is
+    compacted, since they are all decided
+    '''
+
+    PROMISE = 'promise'
+    ACCEPT  = 'accept'
+
+    def __init__(self, directory, flushInterval = 2, flushBatch = 256, logger = None):
+        self.wal = WriteAheadLog(directory, logger = logger)
+
+        # Highest leader ballot promised, valid for every round >= promisedRound
+        self.promisedBallot = None
+        self.promisedRound = None
+
+        # Highest ballot promised in every round, with the value accepted there, if any
+        self.rounds = {}
+
+        for record in self.wal.replay():
+            self.apply(record)
+
+        self.committer = GroupCommit(self.wal, flushInterval, flushBatch)
+        self.committer.setDaemon(True)
+        self.committer.start()
+
+    # We promised ballot for round r, and for every round after it if it is a leader ballot.
+    # callback is called from the committer's thread once that is durable
+    def promise(self, r, ballot, leader, callback = None):
+        self.append((AcceptorLog.PROMISE, r, ballot.n, ballot.nodeIdentifier, leader), callback)
+
+    # We accepted value with ballot in round r
+    def accept(self, r, ballot, value, callback = None):
+        self.append((AcceptorLog.ACCEPT, r, ballot.n, ballot.nodeIdentifier, value), callback)
+
+    def append(self, record, callback):
+        self.apply(record)
+        self.committer.append(record, callback)
+
+    def apply(self, record):
+        kind, r, n, nodeIdentifier, extra = record
+        ballot = codec.makeBallot(n, nodeIdentifier)
+
+        if kind == AcceptorLog.ACCEPT:
+            self.rounds[r] = (ballot, extra)
+            return
+
+        self.rounds[r] = (ballot, self.rounds.get(r, (None, None))[1])
+        if extra and (self.promisedBallot == None or ballot >= self.promisedBallot):
+            self.promisedRound = r if self.promisedBallot == None else min(self.promisedRound, r)
+            self.promisedBallot = ballot
+
+    # Forget every round below round, and rewrite the log with what is left
+    def compact(self, round):
+        for r in [r for r in self.rounds if r < round]:
+            del self.rounds[r]
+
+        records = []
+        if self.promisedBallot:
+            b = self.promisedBallot
+            records.append((AcceptorLog.PROMISE, max(self.promisedRound, round), b.n, b.nodeIdentifier, True))
+        for r, (ballot, value) in sorted(self.rounds.iteritems()):
+            kind = AcceptorLog.PROMISE if value == None else AcceptorLog.ACCEPT
+            records.append((kind, r, ballot.n, ballot.nodeIdentifier, value if value != None else False))
+
+        with self.committer.lock:
+            self.wal.compact(records)
@@ -3,30 +3,30 @@
 class Account(object):
     balance = 0.0
 
+    def __init__(self, balance = 0.0):
+        self.balance = balance
+
     #Check the balance
     def getBalance(self):
-        print ("Your balance is $%.2f" % self.balance)
         return round(self.balance, 2)
 
     #Deposit
     def deposit(self, amount):
         self.balance += round(amount, 2)
-        print "Funds deposited"
         return True
-    
-    #Withdraw if amount is available
+
+    #Withdraw if amount is available. The log applies the same operations in the same
+    #order on every replica, so they all refuse the same withdrawals
     def withdraw(self, amount):
         amount = round(amount, 2)
-        
+
         if self.balance >= amount:
             self.balance -= amount
-            print "Funds withdrawn"
             return True
-        
+
         else:
-            print "Not enough funds available for this withdrawal"
             return False
-    
+
     # Check if we have sufficient balance for withdrawal
     def isSufficient(self, amount):
         return self.balance >= amount
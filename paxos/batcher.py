@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+import threading
+from log import Log
+from collector import Collector
+
+class BatchCompleted(object):
+    '''
+    Completion handle of a batch. Setting it releases every operation in the batch
+    '''
+
+    def __init__(self, events):
+        self.events = events
+
+    def set(self):
+        for event in self.events:
+            event.set()
+
+class Batcher(Collector):
+    '''
+    This class sits in front of Node.initPaxos and packs the operations it is given
+    into batches, so that many operations share a single Paxos round. Batches are
+    handed to the node's event loop
+    '''
+
+    def __init__(self, node, maxItems = 16, maxDelay = 10):
+        '''
+        A batch is proposed once it holds maxItems operations, or maxDelay milliseconds
+        after its first operation arrived, whichever comes first
+        '''
+        Collector.__init__(self, maxItems, maxDelay / 1000.0)
+        self.node = node
+
+    # Queue an operation (type, amount, hash) and return an event set once it is decided
+    def submit(self, value):
+        completed = threading.Event()
+        self.add((value, completed))
+        return completed
+
+    # Propose a batch of operations
+    def flush(self, batch):
+        ops = tuple(value for value, _ in batch)
+        events = [completed for _, completed in batch]
+
+        # A single operation does not need the batch envelope
+        if len(ops) == 1:
+            self.node.loop.callSoon(self.node.initPaxos, None, ops[0], None, events[0])
+            return
+
+        value = (Log.BATCH, ops, hash(tuple(op[2] for op in ops)))
+        self.node.logger.debug('Proposing a batch of {0} operations', len(ops))
+        self.node.loop.callSoon(self.node.initPaxos, None, value, None, BatchCompleted(events))
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+import struct
+import pickle
+import types
+from sets import Set
+from ballot import Ballot
+from message import Message
+from message import TYPE_NAMES
+
+# Binary messages start with MAGIC and the VERSION of the format. Anything else is
+# taken to be a pickled Message from an older node
+MAGIC   = 'PX'
+VERSION = 1
+
+# Magic, version, message type, round, and FLAGS
+HEADER  = struct.Struct('!2sBBqB')
+BALLOT  = struct.Struct('!qQ')
+
+TAG     = struct.Struct('!c')
+INT     = struct.Struct('!q')
+FLOAT   = struct.Struct('!d')
+LENGTH  = struct.Struct('!I')
+KEY     = struct.Struct('!B')
+
+# A ballot follows the header, and whether the message has a round at all
+HAS_BALLOT = 1
+HAS_ROUND  = 2
+
+# Metadata keys sent often enough to be worth a single byte on the wire. Only ever
+# append to this list, since peers index into it
+KEYS = ['value', 'highestballot', 'decided', 'compacted', 'leader', 'maxround',
+        'log', 'applied', 'snapshot', 'session', 'seq', 'missing', 'stream', 'counter',
+        'hashes', 'last', 'end', 'digests', 'reply', 'sent', 'index', 'lease', 'commit',
+        'part', 'accounts']
+KEY_INDEX = dict((key, i) for i, key in enumerate(KEYS))
+
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+# Serialize msg, falling back to pickle for anything the binary format can't express.
+# Peers only accept such a message if they allow pickles, so the fallback is reported
+# as a warning to logger, if given
+def encode(msg, logger = None):
+    try:
+        flags = (HAS_BALLOT if msg.ballot != None else 0) | (HAS_ROUND if msg.round != None else 0)
+        chunks = [HEADER.pack(MAGIC, VERSION, msg.messageType, msg.round or 0, flags)]
+        if msg.ballot != None:
+            chunks.append(BALLOT.pack(msg.ballot.n, msg.ballot.nodeIdentifier))
+        encodeValue(msg.source, chunks)
+        encodeValue(msg.metadata, chunks)
+        return ''.join(chunks)
+
+    except (TypeError, struct.error) as e:
+        if logger:
+            logger.warning('Pickling a {0} message the binary format cannot express: {1!r}',
+                           TYPE_NAMES.get(msg.messageType, msg.messageType), e)
+        return pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+
+# Rebuild a Message from data. Pickled messages are only accepted if allowPickle is set,
+# as unpickling data from an untrusted peer can run arbitrary code
+def decode(data, allowPickle = False):
+    if data[:2] != MAGIC:
+        if not allowPickle:
+            raise ValueError('Refusing a message that is not in the binary format')
+        return pickle.loads(data)
+
+    magic, version, messageType, round, flags = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError('Unknown message format version {0}'.format(version))
+
+    offset = HEADER.size
+    ballot = None
+    if not flags & HAS_ROUND:
+        round = None
+    if flags & HAS_BALLOT:
+        n, nodeIdentifier = BALLOT.unpack_from(data, offset)
+        ballot = makeBallot(n, nodeIdentifier)
+        offset += BALLOT.size
+
+    source, offset = decodeValue(data, offset)
+    metadata, offset = decodeValue(data, offset)
+    return Message(round, messageType, source, ballot, metadata)
+
+# Build a Ballot without going through its constructor, which wants an address
+def makeBallot(n, nodeIdentifier):
+    return types.InstanceType(Ballot, {'n': n, 'nodeIdentifier': nodeIdentifier})
+
+# Append the encoding of value to chunks. Every value starts with a one character tag
+def encodeValue(value, chunks):
+    if value is None:
+        chunks.append('N')
+
+    elif value is True:
+        chunks.append('T')
+
+    elif value is False:
+        chunks.append('F')
+
+    elif isinstance(value, (int, long)):
+        if INT_MIN <= value <= INT_MAX:
+            chunks.append('i' + INT.pack(value))
+        else:
+            encoded = str(value)
+            chunks.append('L' + LENGTH.pack(len(encoded)) + encoded)
+
+    elif isinstance(value, float):
+        chunks.append('d' + FLOAT.pack(value))
+
+    elif isinstance(value, str):
+        chunks.append('s' + LENGTH.pack(len(value)) + value)
+
+    elif isinstance(value, unicode):
+        encoded = value.encode('utf-8')
+        chunks.append('u' + LENGTH.pack(len(encoded)) + encoded)
+
+    elif isinstance(value, Ballot):
+        chunks.append('B' + BALLOT.pack(value.n, value.nodeIdentifier))
+
+    elif isinstance(value, dict):
+        chunks.append('D' + LENGTH.pack(len(value)))
+        for key, item in value.iteritems():
+            if key in KEY_INDEX:
+                chunks.append('k' + KEY.pack(KEY_INDEX[key]))
+            else:
+                encodeValue(key, chunks)
+            encodeValue(item, chunks)
+
+    else:
+        if isinstance(value, tuple):
+            tag = 't'
+        elif isinstance(value, list):
+            tag = 'l'
+        elif isinstance(value, (Set, set, frozenset)):
+            tag = 'S'
+        else:
+            raise TypeError('Cannot encode {0}'.format(type(value)))
+
+        chunks.append(tag + LENGTH.pack(len(value)))
+        for item in value:
+            encodeValue(item, chunks)
+
+# Decode the value starting at offset in data. Returns the value and the offset after it
+def decodeValue(data, offset):
+    tag = data[offset]
+    offset += 1
+
+    if tag == 'N':
+        return None, offset
+
+    elif tag == 'T':
+        return True, offset
+
+    elif tag == 'F':
+        return False, offset
+
+    elif tag == 'i':
+        return INT.unpack_from(data, offset)[0], offset + INT.size
+
+    elif tag == 'd':
+        return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+
+    elif tag == 'k':
+        return KEYS[KEY.unpack_from(data, offset)[0]], offset + KEY.size
+
+    elif tag == 'B':
+        n, nodeIdentifier = BALLOT.unpack_from(data, offset)
+        return makeBallot(n, nodeIdentifier), offset + BALLOT.size
+
+    length = LENGTH.unpack_from(data, offset)[0]
+    offset += LENGTH.size
+
+    if tag in 'sLu':
+        if offset + length > len(data):
+            raise ValueError('Truncated message')
+        raw = data[offset:offset + length]
+        if tag == 'L':
+            raw = long(raw)
+        elif tag == 'u':
+            raw = raw.decode('utf-8')
+        return raw, offset + length
+
+    elif tag == 'D':
+        value = {}
+        for _ in xrange(length):
+            key, offset = decodeValue(data, offset)
+            value[key], offset = decodeValue(data, offset)
+        return value, offset
+
+    elif tag in 'tlS':
+        items = []
+        for _ in xrange(length):
+            item, offset = decodeValue(data, offset)
+            items.append(item)
+
+        if tag == 't':
+            return tuple(items), offset
+        elif tag == 'S':
+            return Set(items), offset
+        return items, offset
+
+    raise ValueError('Unknown value tag {0!r}'.format(tag))
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+import threading
+import time
+
+class Collector(threading.Thread):
+    '''
+    A thread which collects the items other threads hand it into groups, and passes every
+    group to flush in the order the items arrived
+    '''
+
+    def __init__(self, maxItems, maxDelay):
+        '''
+        A group is flushed once it holds maxItems items, or maxDelay seconds after its first
+        item arrived, whichever comes first
+        '''
+        threading.Thread.__init__(self)
+        self.maxItems = maxItems
+        self.maxDelay = maxDelay
+
+        self.pending = []
+        self.firstArrival = None
+        self.condition = threading.Condition()
+
+    # Queue an item from any thread
+    def add(self, item):
+        with self.condition:
+            if not self.pending:
+                self.firstArrival = time.time()
+            self.pending.append(item)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            self.flush(self.collect())
+
+    # Wait for the next group to fill up, but no longer than maxDelay after its first item
+    def collect(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+
+            deadline = self.firstArrival + self.maxDelay
+            while len(self.pending) < self.maxItems:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            group = self.pending[:self.maxItems]
+            self.pending = self.pending[self.maxItems:]
+            if self.pending:
+                self.firstArrival = time.time()
+            return group
+
+    # Handle a group of items, on this thread
+    def flush(self, group):
+        raise NotImplementedError
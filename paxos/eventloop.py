@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import itertools
+import threading
+import collections
+import traceback
+from logger import Logger
+
+class TimerHandle(object):
+    '''
+    A callback scheduled on an EventLoop for a later time. Cancelling it keeps it from
+    running
+    '''
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.callback = None
+        self.args = None
+
+class EventLoop(object):
+    '''
+    A single threaded event loop. It waits on its sockets with select and runs the
+    callbacks of the readable and writable ones, the timers that are due and every callback queued
+    by callSoon. Other threads hand work to the loop through callSoon, which wakes it up
+    through a pipe, so nothing else ever touches the state owned by the loop.
+    
+    Timers live in one heap ordered by deadline. A cancelled timer stays in the heap
+    until it comes up, unless cancelled timers make up most of the heap
+    '''
+
+    def __init__(self, logger = None):
+        # Exceptions escaping a callback are reported to the logger of the loop's node, or to
+        # one of its own
+        if logger == None:
+            logger = Logger('loop')
+            logger.start()
+        self.logger = logger
+        
+        self.ready = collections.deque()
+        self.readers = {}
+        self.writers = {}
+        
+        # (deadline, sequence number, handle), the sequence number keeping equal deadlines in order
+        self.timers = []
+        self.sequence = itertools.count()
+        self.timersFired = 0
+        self.running = False
+        self.thread = None
+
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    # Run callback(*args) on the loop as soon as possible. Safe to call from any thread
+    def callSoon(self, callback, *args):
+        self.ready.append((callback, args))
+        if threading.current_thread() is not self.thread:
+            self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeWrite, 'x')
+        except OSError as e:
+            # The pipe is full, so the loop is going to wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    # Current time of the loop, in seconds
+    def time(self):
+        return time.time()
+
+    # Run callback(*args) on the loop after delay seconds. Returns a TimerHandle
+    def callLater(self, delay, callback, *args):
+        handle = TimerHandle(self.time() + delay, callback, args)
+        if threading.current_thread() is self.thread:
+            self.addTimer(handle)
+        else:
+            self.callSoon(self.addTimer, handle)
+        return handle
+
+    def addTimer(self, handle):
+        if handle.cancelled:
+            return
+        sequence = next(self.sequence)
+        heapq.heappush(self.timers, (handle.when, sequence, handle))
+
+        # Now and then, drop cancelled timers if they are most of the heap
+        if sequence % 64 == 0 and len(self.timers) > 64:
+            live = [timer for timer in self.timers if not timer[2].cancelled]
+            if len(live) < len(self.timers) / 2:
+                heapq.heapify(live)
+                self.timers = live
+
+    # Call callback() whenever fileobj is readable
+    def addReader(self, fileobj, callback):
+        self.readers[fileobj.fileno()] = callback
+        self.wakeup()
+
+    def removeReader(self, fileobj):
+        self.readers.pop(fileobj.fileno(), None)
+
+    # Call callback() whenever fileobj is writable, until removeWriter is called
+    def addWriter(self, fileobj, callback):
+        self.writers[fileobj.fileno()] = callback
+        if threading.current_thread() is not self.thread:
+            self.wakeup()
+
+    def removeWriter(self, fileobj):
+        self.writers.pop(fileobj.fileno(), None)
+
+    # Run until stop is called, in the calling thread
+    def run(self):
+        self.thread = threading.current_thread()
+        self.running = True
+
+        while self.running:
+            timeout = None
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - self.time())
+
+            try:
+                readable, writable, _ = select.select(self.readers.keys() + [self.wakeRead], self.writers.keys(), [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable:
+                if fd == self.wakeRead:
+                    self.drainWakeups()
+                elif fd in self.readers:
+                    self.runCallback(self.readers[fd], ())
+
+            for fd in writable:
+                if fd in self.writers:
+                    self.runCallback(self.writers[fd], ())
+
+            now = self.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, handle = heapq.heappop(self.timers)
+                if not handle.cancelled:
+                    self.timersFired += 1
+                    self.runCallback(handle.callback, handle.args)
+
+            # Only run what is queued now, so callbacks queueing more can't starve the sockets
+            for _ in xrange(len(self.ready)):
+                callback, args = self.ready.popleft()
+                self.runCallback(callback, args)
+
+    def stop(self):
+        self.callSoon(self.halt)
+
+    def halt(self):
+        self.running = False
+
+    def drainWakeups(self):
+        try:
+            while os.read(self.wakeRead, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def runCallback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            self.logger.error('Exception in event loop callback {0}\n{1}', callback, traceback.format_exc())
@@ -1,70 +1,390 @@
 #!/usr/bin/python
 
+import os
+import time
 import pickle
+import threading
+from sets import Set
+from wal import WriteAheadLog
+from wal import GroupCommit
+from roundindex import RoundIndex
+from acceptorlog import AcceptorLog
+from logger import Logger
+from account import Account
 
 class Log():
+    # Fills a round that must be decided for a read to go ahead, and changes nothing
+    NOOP       = 0
+    
     DEPOSIT    = 1 
     WITHDRAW   = 2
     
-    def __init__(self, ip, port):
-        self.filename = 'paxos-' + str(ip) + str(port)+ '.log'
+    # A batch carries a tuple of (type, amount, hash) operations, applied in order
+    BATCH      = 3
+    
+    # Operations may name an account as a fourth element, (type, amount, hash, account).
+    # Those go to the account's balance instead of the balance of the log
+    
+    # Number of rounds before a snapshot for which we still remember value hashes. An
+    # operation decided again within that many rounds of its first decision is skipped
+    DEDUP_ROUNDS = 10000
+    
+    def __init__(self, ip, port, flushInterval = 2, flushBatch = 256, snapshotInterval = 1000, logger = None,
+                 shard = None):
+        # Reports on the log go to the logger of its node, or to one of its own
+        if logger == None:
+            logger = Logger('log')
+            logger.start()
+        self.logger = logger
+        
+        # Whole-log pickle written by older versions, imported once into the write-ahead log.
+        # Every shard of a node keeps a log of its own
+        name = 'paxos-' + str(ip) + str(port) + ('' if shard == None else '-' + str(shard))
+        self.filename = name + '.log'
+        self.wal = WriteAheadLog(name + '.wal', logger = logger)
+        
+        # What the node promised and accepted in rounds not decided yet
+        self.acceptor = AcceptorLog(name + '.acceptor', flushInterval, flushBatch, logger)
+        self.snapshotFile = name + '.snapshot'
         self.transactions = {}
         self.balance = 0
+        
+        # Account of every key that an applied operation named
+        self.accounts = {}
+        
+        # Decided rounds with the balance change of each, for prefix queries over the log
+        self.index = RoundIndex()
+        
+        # Decisions can arrive out of order. Balance only reflects the rounds below
+        # appliedRound, which are all decided, in round order
+        self.appliedRound = 0
+        
+        # Rounds below snapshotRound are folded into the snapshot and no longer kept. A new
+        # snapshot is taken every snapshotInterval applied rounds, and onSnapshot is called
+        # with its round so that others can drop their state for older rounds too
+        self.snapshotRound = 0
+        self.snapshotBalance = 0
+        self.snapshotAccounts = {}
+        self.snapshotInterval = snapshotInterval
+        self.onSnapshot = None
+        
+        # Metrics of the node, if any, which learn how long each save took to become durable
+        self.metrics = None
+        
+        # First round of every value decided recently, keyed by its hash, used to drop duplicate
+        # proposals and to apply an operation decided in several rounds only once
+        self.hashes = {}
         self.restore()
         
-    #Persist the log to disk
-    def save(self):
-        try:
-            with open(self.filename, 'wb') as file:
-                pickle.dump(self.transactions, file)
-                return True
-
-        except Exception as e:
-            return False
+        # Rounds written but not yet fsynced, with the callbacks waiting on each of them
+        self.unsynced = {}
+        self.lock = threading.Lock()
+        
+        self.committer = GroupCommit(self.wal, flushInterval, flushBatch)
+        self.committer.setDaemon(True)
+        self.committer.start()
+        
+    #Persist the transaction of the given round to disk. It is grouped with other rounds
+    #decided around the same time and fsynced together
+    def save(self, round):
+        with self.lock:
+            self.unsynced[round] = []
+        self.committer.append((round,) + self.transactions[round], lambda saved = time.time(): self.synced(round, saved))
+        return True
+    
+    def synced(self, round, saved):
+        if self.metrics:
+            self.metrics.observe('log.save', time.time() - saved)
+        with self.lock:
+            callbacks = self.unsynced.pop(round, [])
+        for callback in callbacks:
+            callback()
+    
+    # Call callback once the given round is durable, right away if it already is
+    def whenDurable(self, round, callback):
+        with self.lock:
+            if round in self.unsynced:
+                self.unsynced[round].append(callback)
+                return
+        callback()
 
     #Read the log from disk
     def restore(self):
         try:
-            with open(self.filename, 'rb') as file:
-                self.transactions = pickle.load(file)
-                print 'Found existing log \'{0}\' with {1} transactions \n'.format(self.filename, len(self.transactions))
-                
-                for key in sorted(iter(self.transactions)):
-                    if self.transactions[key][0] == Log.DEPOSIT:
-                        self.balance += self.transactions[key][1]
-                
-                    elif self.transactions[key][0] == Log.WITHDRAW:
-                        self.balance -= self.transactions[key][1]
-                
-                return True
+            self.importLegacyLog()
+            
+            if os.path.exists(self.snapshotFile):
+                with open(self.snapshotFile, 'rb') as file:
+                    snapshot = pickle.load(file)
+                self.snapshotRound = self.appliedRound = snapshot['round']
+                self.snapshotBalance = self.balance = snapshot['balance']
+                self.snapshotAccounts = snapshot.get('accounts', {})
+                self.accounts = self.makeAccounts(self.snapshotAccounts)
+                self.hashes = snapshot['hashes']
+                self.index = RoundIndex(self.snapshotRound)
+                self.logger.info('Found snapshot \'{0}\' up to round {1}', self.snapshotFile, self.snapshotRound)
+            
+            for record in self.wal.replay():
+                if record[0] >= self.snapshotRound:
+                    self.transactions[record[0]] = record[1:]
+                    self.index.add(record[0], self.getDelta(*record[1:]), self.getDigest(record[0], record[3]))
+            
+            if self.transactions:
+                self.logger.info('Found existing log \'{0}\' with {1} transactions', self.wal.directory, len(self.transactions))
+            
+            for key in self.transactions:
+                self.addHashes(key, *self.transactions[key])
+            self.applyDecided(False)
+            
+            return True
 
         except Exception as e:
+            self.logger.error('Could not restore the log: {0}', e)
             return False
+    
+    # Move a pickled log from an older version into the write-ahead log
+    def importLegacyLog(self):
+        if not os.path.exists(self.filename) or not self.wal.isEmpty():
+            return
+        
+        with open(self.filename, 'rb') as file:
+            transactions = pickle.load(file)
+        
+        for key in sorted(iter(transactions)):
+            self.wal.append((key,) + tuple(transactions[key]))
+        self.wal.sync()
+        
+        os.rename(self.filename, self.filename + '.imported')
+        self.logger.info('Imported {0} transactions from \'{1}\'', len(transactions), self.filename)
 
-    def addTransaction(self, round, type, value, hash):
-        if round in self.transactions: return
+    def addTransaction(self, round, type, value, hash, account = None):
+        if self.recordTransaction(round, type, value, hash, account):
+            self.applyDecided()
+    
+    # Add the transactions of several decided rounds, given as (round, value) pairs, and
+    # apply them together
+    def addTransactions(self, entries):
+        added = False
+        for round, value in entries:
+            added = self.recordTransaction(round, *value) or added
+        if added:
+            self.applyDecided()
+    
+    # Keep and save the transaction of a round without applying it. Returns whether the
+    # round was new
+    def recordTransaction(self, round, type, value, hash, account = None):
+        if round in self.transactions or round < self.snapshotRound: return False
+
+        self.transactions[round] = (type, value, hash) if account == None else (type, value, hash, account)
+        self.index.add(round, self.getDelta(type, value, hash, account), self.getDigest(round, hash))
+        self.addHashes(round, type, value, hash, account)
+        self.save(round)
+        return True
+    
+    # Whether round has been decided, including rounds folded into the snapshot
+    def isDecided(self, round):
+        return round < self.snapshotRound or round in self.transactions
+    
+    # Apply decided transactions to the balance in round order, up to the first missing round
+    def applyDecided(self, snapshot = True):
+        applied, self.appliedRound = self.appliedRound, self.index.firstGap()
+        for round in xrange(applied, self.appliedRound):
+            self.applyRound(round)
+        self.balance = self.balanceAt(self.appliedRound - 1)
         
-        if type == Log.DEPOSIT:
-            self.balance += value
+        if snapshot and self.appliedRound - self.snapshotRound >= self.snapshotInterval:
+            self.snapshot()
+    
+    # Apply the operations of a round, skipping those already decided in an earlier round.
+    # Every replica sees the same earlier rounds, so all of them skip the same operations
+    def applyRound(self, round):
+        transaction = self.transactions[round]
+        ops = transaction[1] if transaction[0] == Log.BATCH else [transaction]
+        
+        fresh = []
+        seen = Set()
+        for op in ops:
+            if op[2] in seen or self.decidedBefore(op[2], round):
+                self.logger.debug('Skipped operation {0} of round {1}, decided before', op[2], round)
+                continue
+            seen.add(op[2])
+            fresh.append(op)
+        
+        if len(fresh) < len(ops):
+            self.index.setDelta(round, sum(self.getDelta(*op) for op in fresh))
+        for op in fresh:
+            self.applyToAccounts(*op)
+    
+    # Whether the operation with the given hash was decided in a round before round, within
+    # DEDUP_ROUNDS of it
+    def decidedBefore(self, hash, round):
+        first = self.hashes.get(hash)
+        return first != None and first < round and round - first <= Log.DEDUP_ROUNDS
+    
+    # Fold every applied round into a snapshot and drop them from memory and disk
+    def snapshot(self):
+        self.compact(self.appliedRound)
+        self.logger.info('Took a snapshot up to round {0}', self.snapshotRound)
+    
+    # Snapshot state to hand to a replica that is behind: (round, balance, hashes, accounts)
+    def snapshotState(self):
+        return (self.snapshotRound, self.snapshotBalance, self.hashes, self.snapshotAccounts)
+    
+    # Jump ahead to a snapshot taken by another replica
+    def installSnapshot(self, round, balance, hashes, accounts = None):
+        if round <= self.appliedRound: 
+            return
+        
+        self.balance = balance
+        self.accounts = self.makeAccounts(accounts or {})
+        self.appliedRound = round
+        for h in hashes:
+            self.addHash(h, hashes[h])
+        self.compact(round)
+        self.applyDecided()
+        self.logger.info('Installed a snapshot up to round {0}', round)
+    
+    def compact(self, round):
+        self.snapshotRound = round
+        self.snapshotBalance = self.balance
+        self.snapshotAccounts = dict((key, account.balance) for key, account in self.accounts.iteritems())
+        
+        # Only remember value hashes of recent rounds
+        oldest = round - Log.DEDUP_ROUNDS
+        for h in [h for h in self.hashes if self.hashes[h] < oldest]:
+            del self.hashes[h]
+        
+        # Write the snapshot next to the old one and swap it in, so a crash leaves one intact
+        temp = self.snapshotFile + '.tmp'
+        with open(temp, 'wb') as file:
+            pickle.dump({'round': round, 'balance': self.balance, 'hashes': self.hashes,
+                         'accounts': self.snapshotAccounts}, file, pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(temp, self.snapshotFile)
+        
+        for key in [key for key in self.transactions if key < round]:
+            del self.transactions[key]
+        self.index.rebase(round)
+        
+        # Rewrite the rounds decided beyond the snapshot into a fresh segment, dropping the rest
+        records = [(key,) + self.transactions[key] for key in sorted(iter(self.transactions))]
+        with self.committer.lock:
+            self.wal.compact(records)
+        self.acceptor.compact(round)
+        
+        if self.onSnapshot:
+            self.onSnapshot(round)
+    
+    # Change to the balance made by a value. Operations on an account leave it unchanged
+    def getDelta(self, type, value, hash = None, account = None):
+        if account != None:
+            return 0
+        
+        elif type == Log.DEPOSIT:
+            return value
 
         elif type == Log.WITHDRAW:
-            self.balance -= value
-
-        self.transactions[round] = (type, value, hash)
-        self.save()
+            return -value
+        
+        elif type == Log.BATCH:
+            return sum(self.getDelta(*op) for op in value)
+        
+        return 0
+    
+    # Apply a value to the accounts it names, in order. A withdrawal beyond the balance of
+    # its account is refused, the same way on every replica
+    def applyToAccounts(self, type, value, hash, account = None):
+        if type == Log.BATCH:
+            for op in value:
+                self.applyToAccounts(*op)
+        
+        elif account != None:
+            if account not in self.accounts:
+                self.accounts[account] = Account()
+            
+            if type == Log.DEPOSIT:
+                self.accounts[account].deposit(value)
+            elif type == Log.WITHDRAW and not self.accounts[account].withdraw(value):
+                self.logger.debug('Refused a withdrawal of {0} from account {1}', value, account)
+    
+    def makeAccounts(self, balances):
+        return dict((key, Account(balance)) for key, balance in balances.iteritems())
+    
+    # Balance of an account once every applied round is applied
+    def getAccountBalance(self, account):
+        if account not in self.accounts:
+            return 0.0
+        return self.accounts[account].getBalance()
+    
+    # Digest of the value decided in round, from its hash
+    def getDigest(self, round, valueHash):
+        return hash((round, valueHash))
+    
+    # Balance once every round up to and including round is applied, or None if that
+    # round is not applied yet or already folded into the snapshot
+    def balanceAt(self, round):
+        if round < self.snapshotRound - 1 or round >= self.appliedRound:
+            return None
+        return self.snapshotBalance + self.index.prefix(round)[1]
+    
+    # First round which is not decided yet
+    def firstGap(self):
+        return self.index.firstGap()
+    
+    # First round from round onwards that is not decided
+    def nextGap(self, round):
+        return self.index.nextGap(round)
+    
+    # Round after the highest decided one
+    def endRound(self):
+        return self.index.last() + 1
+    
+    # Remember the hash of a value and of every operation in it
+    def addHashes(self, round, type, value, hash, account = None):
+        self.addHash(hash, round)
+        if type == Log.BATCH:
+            for op in value:
+                self.addHash(op[2], round)
+    
+    # Remember the first round a hash was decided in, whatever order rounds arrive in
+    def addHash(self, hash, round):
+        if self.hashes.get(hash, round) >= round:
+            self.hashes[hash] = round
 
-    def history(self):
-        if not self.transactions:
+    # Print the decided rounds between lo and hi inclusive, by default the whole log
+    def history(self, lo = None, hi = None):
+        lo = self.snapshotRound if lo == None else max(lo, self.snapshotRound)
+        hi = self.index.base + self.index.size if hi == None else hi
+        
+        if lo == self.snapshotRound and self.snapshotRound:
+            print 'Rounds below {0} are in the snapshot'.format(self.snapshotRound)
+        
+        elif not self.transactions:
             print '[ EMPTY ]'
 
-        for key in sorted(iter(self.transactions)):
-            if self.transactions[key][0] == Log.DEPOSIT:
-                print '{0} - Deposit:  ${1}'.format(key, self.transactions[key][1])
-
-            elif self.transactions[key][0] == Log.WITHDRAW:
-                print '{0} - Withdraw: ${1}'.format(key, self.transactions[key][1])
+        for key in self.index.rounds(lo, hi):
+            if self.transactions[key][0] == Log.BATCH:
+                for op in self.transactions[key][1]:
+                    self.printTransaction(key, *op)
+            else:
+                self.printTransaction(key, *self.transactions[key])
         
+        if lo <= hi and self.balanceAt(hi) != None:
+            print 'Balance after round {0}: {1}'.format(hi, self.balanceAt(hi))
         print 'Balance: {0}'.format(self.balance)
+        if self.accounts:
+            print 'Accounts: {0}'.format(len(self.accounts))
+        if len(self.index) > self.appliedRound - self.snapshotRound:
+            print 'Waiting on round {0} before applying later rounds'.format(self.appliedRound)
+
+    def printTransaction(self, round, type, value, hash = None, account = None):
+        to = '' if account == None else ' ({0})'.format(account)
+        if type == Log.DEPOSIT:
+            print '{0} - Deposit:  ${1}{2}'.format(round, value, to)
+
+        elif type == Log.WITHDRAW:
+            print '{0} - Withdraw: ${1}{2}'.format(round, value, to)
 
     def __str__(self):
         return ('Num transactions:       {0}\n'
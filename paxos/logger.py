@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import sys
+import time
+import threading
+import collections
+
+class Logger(threading.Thread):
+    '''
+    A leveled logger which keeps the formatting and writing of records off the calling
+    thread. Records below the logger's level are dropped before anything is formatted.
+    The rest wait in a ring buffer of at most capacity records, oldest dropped first,
+    until the logger's thread formats them and writes them to stream.
+
+    Format strings use str.format and are only filled in by the writer, so arguments
+    should not change after they are logged
+    '''
+
+    TRACE   = 5
+    DEBUG   = 10
+    INFO    = 20
+    WARNING = 30
+    ERROR   = 40
+
+    LEVELS = {'trace': TRACE, 'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+    NAMES = dict((level, name.upper()) for name, level in LEVELS.iteritems())
+
+    def __init__(self, name, level = INFO, stream = sys.stdout, capacity = 10000):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.name = name
+        self.level = level
+        self.stream = stream
+        self.records = collections.deque(maxlen = capacity)
+        self.pending = threading.Condition(threading.Lock())
+        self.dropped = 0
+
+    # Level from its name, such as 'info'
+    @staticmethod
+    def getLevel(name):
+        if name.lower() not in Logger.LEVELS:
+            raise ValueError('Unknown log level {0}'.format(name))
+        return Logger.LEVELS[name.lower()]
+
+    def isEnabled(self, level):
+        return level >= self.level
+
+    def log(self, level, fmt, *args):
+        if level < self.level:
+            return
+
+        with self.pending:
+            if len(self.records) == self.records.maxlen:
+                self.dropped += 1
+            self.records.append((time.time(), level, fmt, args))
+            self.pending.notify()
+
+    def trace(self, fmt, *args):
+        self.log(Logger.TRACE, fmt, *args)
+
+    def debug(self, fmt, *args):
+        self.log(Logger.DEBUG, fmt, *args)
+
+    def info(self, fmt, *args):
+        self.log(Logger.INFO, fmt, *args)
+
+    def warning(self, fmt, *args):
+        self.log(Logger.WARNING, fmt, *args)
+
+    def error(self, fmt, *args):
+        self.log(Logger.ERROR, fmt, *args)
+
+    def run(self):
+        while True:
+            with self.pending:
+                while not self.records:
+                    self.pending.wait()
+                records = list(self.records)
+                self.records.clear()
+                dropped, self.dropped = self.dropped, 0
+
+            if dropped:
+                self.stream.write('{0} WARNING {1}: Dropped {2} log records\n'.format(
+                    self.formatTime(time.time()), self.name, dropped))
+            self.stream.write(''.join(self.format(record) for record in records))
+            self.stream.flush()
+
+            # Let the buffer refill a little, so each write carries more records
+            time.sleep(0.001)
+
+    def format(self, record):
+        when, level, fmt, args = record
+        try:
+            text = fmt.format(*args)
+        except Exception as e:
+            text = '{0} (could not format: {1})'.format(fmt, e)
+        return '{0} {1} {2}: {3}\n'.format(self.formatTime(when), Logger.NAMES[level], self.name, text)
+
+    def formatTime(self, when):
+        return '{0}.{1:03d}'.format(time.strftime('%H:%M:%S', time.localtime(when)), int(when * 1000) % 1000)
+
+    # Wait until every record logged so far is written, or timeout seconds have passed
+    def flush(self, timeout = 1.0):
+        deadline = time.time() + timeout
+        while self.records and time.time() < deadline:
+            time.sleep(0.001)
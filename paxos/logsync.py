@@ -0,0 +1,419 @@
+#!/usr/bin/python
+
+import random
+import codec
+from sets import Set
+from message import Message
+
+class SyncStream(object):
+    '''
+    Rounds one node is streaming to another. The rounds are read from the log a chunk
+    at a time as the receiver acknowledges earlier chunks, so a stream of any length
+    only ever holds a window of chunks in memory
+    '''
+
+    def __init__(self, session, addr, missing, now):
+        self.session = session
+        self.addr = addr
+
+        # Ranges of rounds the receiver is missing, as (lo, hi) with hi exclusive or None
+        self.missing = list(missing)
+        
+        # Snapshot being sent, as (round, balance), and its parts not sent yet
+        self.snapshot = None
+        self.snapshotParts = None
+        self.snapshotTotal = 0
+
+        self.nextSeq = 0
+        self.unacked = {}
+        self.done = False
+        self.lastProgress = now
+        self.retries = 0
+
+class SnapshotParts(object):
+    '''
+    Parts of a snapshot one node is receiving from another. Parts can arrive in any order,
+    and the snapshot is only installed once all of them are in, with every value hash
+    '''
+
+    def __init__(self, session, round, total):
+        self.session = session
+        self.round = round
+        self.total = total
+        self.received = Set()
+        self.snapshot = None
+        self.hashes = {}
+        self.accounts = {}
+
+class LogSync(object):
+    '''
+    This class brings the log of a lagging node up to date. The lagging node sends a
+    summary of the rounds it is missing and one peer streams them back in chunks small
+    enough for a single datagram, along with its snapshot if the node is behind it.
+    Chunks are acknowledged one by one, at most WINDOW of them are unacknowledged at a
+    time, and lost chunks are sent again. A stream that stalls is resumed by asking
+    again, since the new summary leaves out every round that did arrive.
+    
+    In the background, nodes send a digest of their log to a random peer now and then:
+    the first missing round, the end of the log and the number and xor digest of the
+    rounds in each of a few ranges in between. A peer whose digest differs asks for the
+    rounds it is missing, or replies with its own digest so that the other node does
+    '''
+
+    # Bytes of log entries per chunk, leaving room for the header within 4096 bytes
+    CHUNK_BYTES = 3072
+
+    # Chunks a sender may have unacknowledged at once
+    WINDOW = 8
+
+    # Seconds before an unacknowledged chunk is sent again, until we have a round trip time
+    # to the receiver, and resends before giving up
+    TIMEOUT = 1.0
+    RETRIES = 5
+
+    # Most missing ranges we describe in one request. Anything beyond is asked for whole
+    MAX_RANGES = 64
+    
+    # Most ranges in a digest, and the fewest rounds a range covers
+    MAX_DIGESTS = 64
+    DIGEST_ROUNDS = 256
+
+    def __init__(self, node):
+        self.node = node
+        self.log = node.log
+
+        # Streams we are sending, keyed by receiver address
+        self.streams = {}
+
+        # Peers we are receiving from, with the session, the time we last heard from them
+        # and how many times we asked again already
+        self.sessions = {}
+        
+        # Snapshots we are receiving, keyed by sender address
+        self.snapshots = {}
+
+        self.timer = None
+        self.antiEntropyInterval = 0
+
+    # Ask addr, or else the leader or a random peer, for every round we are missing.
+    # Every other peer gets the summary too, to fetch whatever rounds only we have. A
+    # counter request answers such a summary and is not answered with another one
+    def request(self, addr = None, counter = False, attempt = 0):
+        if not self.node.serverSet:
+            return
+
+        source = addr
+        if source == None:
+            if self.node.leader and self.node.leader != self.node.addr:
+                source = self.node.leader
+            else:
+                source = random.choice(list(self.node.serverSet))
+
+        session = random.getrandbits(32)
+        missing = self.getMissing()
+
+        self.sessions[source] = (session, self.node.loop.time(), attempt)
+        self.schedule()
+
+        self.node.logger.info('Syncing {0} missing ranges from {1}', len(missing), source)
+        for server in ([source] if addr else self.node.serverSet):
+            metadata = {'session': session, 'applied': self.log.appliedRound, 'missing': missing,
+                        'stream': server == source}
+            if counter:
+                metadata['counter'] = True
+            self.node.sendMessage(Message(None, Message.LOG_SYNC_REQUEST, self.node.addr, None, metadata), server)
+
+    # Ranges of rounds we have not decided, from the first gap on. The last range is open
+    def getMissing(self):
+        index = self.log.index
+        missing = []
+        r = self.log.appliedRound
+        while len(missing) < LogSync.MAX_RANGES - 1:
+            gap = index.nextGap(r)
+            decided = index.nextDecided(gap)
+            if decided == None:
+                break
+            missing.append((gap, decided))
+            r = decided
+        missing.append((index.nextGap(r), None))
+        return missing
+
+    # First round of the open range, beyond which the summary's owner has decided nothing
+    def getEnd(self, missing):
+        return missing[-1][0] if missing else 0
+    
+    # Send a digest of our log to a random peer every interval seconds
+    def startAntiEntropy(self, interval):
+        self.antiEntropyInterval = interval
+        if interval > 0:
+            self.node.loop.callLater(interval, self.antiEntropy)
+    
+    def antiEntropy(self):
+        try:
+            if self.node.serverSet:
+                self.sendDigest(random.choice(list(self.node.serverSet)))
+        finally:
+            self.startAntiEntropy(self.antiEntropyInterval)
+    
+    def sendDigest(self, addr, reply = False):
+        applied = self.log.appliedRound
+        end = applied
+        if len(self.log.index):
+            end = max(end, self.log.index.select(len(self.log.index) - 1) + 1)
+        
+        step = max(LogSync.DIGEST_ROUNDS, -(-(end - applied) // LogSync.MAX_DIGESTS))
+        digests = []
+        for lo in xrange(applied, end, step):
+            hi = min(lo + step, end)
+            digests.append((lo, hi) + self.log.index.digest(lo, hi))
+        
+        metadata = {'applied': applied, 'end': end, 'digests': digests}
+        if reply:
+            metadata['reply'] = True
+        self.node.sendMessage(Message(None, Message.LOG_DIGEST, self.node.addr, None, metadata), addr)
+    
+    # Compare the digest of a peer with our log. Ask for what we are missing, and tell the
+    # peer if it is missing something, unless the digest already is such a reply
+    def processDigest(self, msg):
+        metadata = msg.metadata
+        snapshotRound = self.log.snapshotRound
+        ourEnd = self.log.appliedRound
+        if len(self.log.index):
+            ourEnd = max(ourEnd, self.log.index.select(len(self.log.index) - 1) + 1)
+        
+        theyHaveMore = metadata['applied'] > self.log.appliedRound or metadata['end'] > ourEnd
+        weHaveMore = self.log.appliedRound > metadata['applied'] or ourEnd > metadata['end']
+        
+        for lo, hi, count, digest in metadata['digests']:
+            # Rounds in our snapshot are all decided, but their digests are gone
+            if lo < snapshotRound:
+                ourCount = min(hi, snapshotRound) - lo
+                if hi > snapshotRound:
+                    ourCount += self.log.index.digest(snapshotRound, hi)[0]
+                ourDigest = digest
+            else:
+                ourCount, ourDigest = self.log.index.digest(lo, hi)
+            
+            if ourCount < count or ourDigest != digest:
+                theyHaveMore = True
+            if ourCount > count or ourDigest != digest:
+                weHaveMore = True
+        
+        if theyHaveMore and msg.source not in self.sessions:
+            self.node.logger.info('Log differs from {0}. Syncing', msg.source)
+            self.request(msg.source, counter = True)
+        
+        if weHaveMore and not metadata.get('reply'):
+            self.sendDigest(msg.source, reply = True)
+
+    def processRequest(self, msg):
+        metadata = msg.metadata
+
+        # The requester has rounds we lack. Ask it for them, unless this is already such a request
+        if not metadata.get('counter'):
+            ourEnd = self.getEnd(self.getMissing())
+            if metadata['applied'] > self.log.appliedRound or self.getEnd(metadata['missing']) > ourEnd:
+                self.request(msg.source, counter = True)
+
+        if not metadata.get('stream'):
+            return
+
+        stream = SyncStream(metadata['session'], msg.source, metadata['missing'], self.node.loop.time())
+        self.streams[msg.source] = stream
+        self.fill(stream)
+        self.schedule()
+
+    # Send chunks until the window of stream is full
+    def fill(self, stream):
+        while not stream.done and len(stream.unacked) < LogSync.WINDOW:
+            chunk = self.nextChunk(stream)
+            stream.unacked[chunk.metadata['seq']] = (chunk, self.node.loop.time(), False)
+            self.node.sendMessage(chunk, stream.addr)
+
+        if stream.done and not stream.unacked:
+            self.node.logger.info('Finished syncing {0}', stream.addr)
+            del self.streams[stream.addr]
+
+    # Read the next chunk of stream from the log
+    def nextChunk(self, stream):
+        metadata = {'session': stream.session, 'seq': stream.nextSeq}
+        stream.nextSeq += 1
+        size = 0
+
+        # Rounds the receiver misses were folded into our snapshot, maybe while streaming.
+        # Send the snapshot first and continue after it
+        if stream.missing and stream.missing[0][0] < self.log.snapshotRound and stream.snapshotParts == None:
+            round, balance, hashes, accounts = self.log.snapshotState()
+            stream.snapshot = (round, balance)
+            stream.snapshotParts = self.splitSnapshot(hashes, accounts)
+            stream.snapshotTotal = len(stream.snapshotParts)
+            stream.missing = [(max(lo, round), hi) for lo, hi in stream.missing if hi == None or hi > round]
+
+        # The snapshot goes in parts, each with some of its accounts and of its value hashes,
+        # so the receiver keeps dropping duplicates. The first part carries the snapshot itself
+        if stream.snapshotParts:
+            part = stream.snapshotTotal - len(stream.snapshotParts)
+            metadata['hashes'], metadata['accounts'], size = stream.snapshotParts.pop(0)
+            metadata['part'] = (stream.snapshot[0], part, stream.snapshotTotal)
+            if part == 0:
+                metadata['snapshot'] = stream.snapshot
+
+        entries = {}
+        while stream.missing and size < LogSync.CHUNK_BYTES:
+            lo, hi = stream.missing[0]
+            if lo < self.log.snapshotRound:
+                # Compacted under us. The next chunk starts with the snapshot
+                stream.snapshotParts = None
+                break
+
+            round = self.log.index.nextDecided(lo)
+            if round == None or (hi != None and round >= hi):
+                stream.missing.pop(0)
+                continue
+
+            entries[round] = self.log.transactions[round]
+            size += self.entrySize(round, entries[round])
+            stream.missing[0] = (round + 1, hi)
+        metadata['log'] = entries
+
+        if not stream.missing and not stream.snapshotParts:
+            metadata['last'] = True
+            stream.done = True
+
+        return Message(None, Message.LOG_SYNC_RESPONSE, self.node.addr, None, metadata)
+
+    # Split the value hashes and the accounts of a snapshot into parts that each fit a
+    # chunk, as (hashes, accounts, size)
+    def splitSnapshot(self, hashes, accounts):
+        parts = [({}, {}, 0)]
+        for i, items in enumerate((hashes, accounts)):
+            for key, value in items.iteritems():
+                size = self.entrySize(key, value)
+                if parts[-1][2] and parts[-1][2] + size > LogSync.CHUNK_BYTES:
+                    parts.append(({}, {}, 0))
+                parts[-1][i][key] = value
+                parts[-1] = parts[-1][:2] + (parts[-1][2] + size,)
+        return parts
+
+    def entrySize(self, key, value):
+        chunks = []
+        codec.encodeValue(key, chunks)
+        codec.encodeValue(value, chunks)
+        return sum(len(chunk) for chunk in chunks)
+
+    # Apply a chunk and acknowledge it
+    def processChunk(self, msg):
+        metadata = msg.metadata
+
+        if msg.source in self.sessions and self.sessions[msg.source][0] == metadata['session']:
+            if metadata.get('last'):
+                del self.sessions[msg.source]
+            else:
+                self.sessions[msg.source] = (metadata['session'], self.node.loop.time(), 0)
+
+        if metadata.get('part'):
+            self.collectSnapshot(msg.source, metadata)
+        else:
+            # Older nodes send the snapshot in one chunk, without its accounts, and its
+            # value hashes after it
+            if metadata.get('snapshot'):
+                round, balance = metadata['snapshot'][:2]
+                accounts = metadata['snapshot'][2] if len(metadata['snapshot']) > 2 else {}
+                self.log.installSnapshot(round, balance, {}, accounts)
+            for h, round in metadata.get('hashes', {}).iteritems():
+                self.log.addHash(h, round)
+
+        for round in sorted(metadata['log']):
+            if not self.log.isDecided(round):
+                self.log.addTransaction(round, *metadata['log'][round])
+                self.node.removeRound(round)
+                self.node.completeRound(round, metadata['log'][round])
+
+        ack_msg = Message(None,
+                          Message.LOG_SYNC_ACK,
+                          self.node.addr,
+                          None,
+                          {'session': metadata['session'], 'seq': metadata['seq']})
+        self.node.sendMessage(ack_msg, msg.source)
+
+    # Keep a part of a snapshot, and install the snapshot once every part arrived. Its value
+    # hashes must all be in first, or the log would propose again values the snapshot decided
+    def collectSnapshot(self, source, metadata):
+        round, part, total = metadata['part']
+        parts = self.snapshots.get(source)
+        if not parts or parts.session != metadata['session'] or parts.round != round:
+            parts = self.snapshots[source] = SnapshotParts(metadata['session'], round, total)
+        
+        if part in parts.received:
+            return
+        parts.received.add(part)
+        parts.hashes.update(metadata['hashes'])
+        parts.accounts.update(metadata['accounts'])
+        if metadata.get('snapshot'):
+            parts.snapshot = metadata['snapshot']
+        
+        if len(parts.received) == parts.total:
+            del self.snapshots[source]
+            round, balance = parts.snapshot
+            self.log.installSnapshot(round, balance, parts.hashes, parts.accounts)
+
+    def processAck(self, msg):
+        stream = self.streams.get(msg.source)
+        if not stream or stream.session != msg.metadata['session']:
+            return
+
+        unacked = stream.unacked.pop(msg.metadata['seq'], None)
+        if unacked:
+            _, sent, resent = unacked
+            stream.lastProgress = self.node.loop.time()
+            stream.retries = 0
+            
+            # A resent chunk's ACK could answer either copy, so it says nothing about the round trip
+            if not resent:
+                self.node.rtt.sample(msg.source, stream.lastProgress - sent)
+        self.fill(stream)
+
+    # Run tick while anything is being synced, as often as the quickest receiver times out
+    def schedule(self):
+        if self.timer or not (self.streams or self.sessions):
+            return
+        delay = min([self.node.rtt.timeout(addr) for addr in self.streams] + [LogSync.TIMEOUT])
+        self.timer = self.node.loop.callLater(delay, self.tick)
+
+    # Resend chunks which were not acknowledged in time, and ask again for streams that stalled
+    def tick(self):
+        now = self.node.loop.time()
+        stalled = []
+
+        self.timer = None
+
+        for addr, stream in self.streams.items():
+            if now - stream.lastProgress < self.node.rtt.timeout(addr):
+                continue
+
+            stream.retries += 1
+            if stream.retries > LogSync.RETRIES:
+                self.node.logger.info('Giving up syncing {0}', addr)
+                del self.streams[addr]
+                continue
+
+            stream.lastProgress = now
+            for seq, (chunk, sent, resent) in sorted(stream.unacked.items()):
+                self.node.sendMessage(chunk, addr)
+                stream.unacked[seq] = (chunk, now, True)
+
+        for addr, (session, heard, attempt) in self.sessions.items():
+            if now - heard < LogSync.TIMEOUT * LogSync.RETRIES:
+                continue
+
+            del self.sessions[addr]
+            if attempt < LogSync.RETRIES:
+                stalled.append((addr, attempt + 1))
+
+        # Resume from another peer if the one we asked went quiet
+        for addr, attempt in stalled:
+            self.node.logger.info('Sync from {0} stalled. Asking again', addr)
+            others = list(self.node.serverSet - Set([addr])) or [addr]
+            self.request(random.choice(others), attempt = attempt)
+
+        self.schedule()
@@ -14,6 +14,16 @@ class Message():
     
     LOG_SYNC_REQUEST    = 7
     LOG_SYNC_RESPONSE   = 8
+    
+    CLIENT_FORWARD      = 9
+    
+    LOG_SYNC_ACK        = 10
+    LOG_DIGEST          = 11
+    
+    READ_INDEX_REQUEST  = 12
+    READ_INDEX_RESPONSE = 13
+    
+    PROPOSER_COMMIT     = 14
         
     def __init__(self, round, messageType, source, ballot = None, metadata = None):
         self.source = source
@@ -32,4 +42,7 @@ class Message():
                                         self.ballot, 
                                         self.messageType, 
                                         self.metadata))
-                        
\ No newline at end of file
+                        
+
+# Name of every message type, for reports
+TYPE_NAMES = dict((value, name) for name, value in vars(Message).items() if name.isupper())
@@ -3,74 +3,76 @@ Created on Dec 3, 2014
 @author: Karthik Puthraya
 '''
 
-import threading
-import Queue
 import sys
+import errno
 import socket
-import time
+from eventloop import EventLoop
+from logger import Logger
 
-class MessagePump(threading.Thread):
+class MessagePump(object):
     '''
     This class listens to a port on a node and passes the messages it receives to
-    the main thread.
+    the node's event loop.
     '''
-    
-    def __init__(self, queue, msgReceived, owner = None, ip = None, port = 55555):
+
+    # Most datagrams read in one go, so one busy socket can't hold up the rest of the loop
+    MAX_READS = 64
+
+    def __init__(self, loop, datagramReceived, owner = None, ip = None, port = 55555, logger = None):
         '''
-        The MessagePump binds itself to port and appends all the messages it receives
-        to a queue
+        The MessagePump binds itself to port and calls datagramReceived(data, addr) on
+        the loop for every message it receives. It reports to logger, by default the
+        logger of the loop
         '''
-        threading.Thread.__init__(self)
         self.owner = owner
+        self.logger = logger or loop.logger
         if ip == None:
             self.ip = socket.gethostbyname(socket.gethostname())
-            print socket.gethostbyname(socket.gethostname())
         else:
             self.ip = ip
         self.port = port
-        self.queue = queue
-        self.msgReceived = msgReceived
+        self.loop = loop
+        self.datagramReceived = datagramReceived
         self.socket = None
         self.isRunning = True
-    
-    def run(self):
-        print 'Starting message pump and listening to {0}:{1}'.format(self.ip, self.port)
+
+    def start(self):
+        self.logger.info('Starting message pump and listening to {0}:{1}', self.ip, self.port)
 
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.socket.bind((self.ip, self.port))
+            self.socket.setblocking(False)
             self.isRunning = True
-        
-            #self.socket.settimeout( timeout )
-        
+
         except Exception as e:
             if self.socket:
                 self.socket.close()
-            
-            print 'Could not open/bind to socket.'
-            print 'Exception message: ', e
+
+            self.logger.error('Could not open/bind to socket {0}:{1}: {2}', self.ip, self.port, e)
+            self.logger.flush()
             sys.exit(1)
-        
-        # Listen forever on the port and add received messages to the queue
-        while True:
-                data, addr = self.socket.recvfrom(4096)
-                if self.isRunning:
-                    self.queue.put((data, addr))
-                    self.msgReceived.set()
-    
+
+        self.loop.addReader(self.socket, self.readable)
+
+    # Read the datagrams waiting on the socket and hand them to the owner
+    def readable(self):
+        for _ in xrange(MessagePump.MAX_READS):
+            try:
+                data, addr = self.socket.recvfrom(65535)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            if self.isRunning:
+                self.datagramReceived(data, addr)
+
 if __name__ == '__main__':
-    queue = Queue.Queue()
-    msgReceived = threading.Event()
-    msgReceived.clear()
-    
-    mp = MessagePump(queue, msgReceived)
-    mp.setDaemon(True)
+    def printDatagram(data, addr):
+        print addr, data
+
+    loop = EventLoop()
+    mp = MessagePump(loop, printDatagram)
     mp.start()
-    
-    while True:
-        msgReceived.wait()
-        if not queue.empty():
-            data, addr = queue.get()
-            print addr, data
-        msgReceived.clear()
-    
\ No newline at end of file
+    loop.run()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+import json
+import math
+import errno
+import socket
+import threading
+
+class Histogram(object):
+    '''
+    Latencies in seconds, counted in buckets which grow by FACTOR from BASE onwards, so
+    percentiles are accurate to within about 20% whatever the scale
+    '''
+
+    BASE    = 1e-5
+    FACTOR  = 2 ** 0.25
+    BUCKETS = 100
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        if value <= Histogram.BASE:
+            i = 0
+        else:
+            i = min(Histogram.BUCKETS - 1, int(math.ceil(math.log(value / Histogram.BASE, Histogram.FACTOR))))
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min == None else min(self.min, value)
+        self.max = value if self.max == None else max(self.max, value)
+
+    # Smallest bucket bound that at least a fraction p of the samples fall under
+    def percentile(self, p):
+        if not self.count:
+            return None
+
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= p * self.count:
+                return min(self.max, max(self.min, Histogram.BASE * Histogram.FACTOR ** i))
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+class Metrics(object):
+    '''
+    Counters, latency histograms and gauges of a node. Counters and histograms can be
+    updated from any thread. Gauges are functions read whenever a snapshot is taken
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    # Every metric as plain data: {'counters': ..., 'gauges': ..., 'latencies': ...}
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            latencies = dict((name, histogram.summary()) for name, histogram in self.histograms.iteritems())
+
+        gauges = {}
+        for name, function in self.gauges.iteritems():
+            try:
+                gauges[name] = function()
+            except Exception:
+                gauges[name] = None
+
+        return {'counters': counters, 'gauges': gauges, 'latencies': latencies}
+
+    # The snapshot as text, one metric per line
+    def report(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        lines.append('Latencies (ms):')
+        for name, summary in sorted(snapshot['latencies'].iteritems()):
+            if not summary['count']:
+                continue
+            lines.append('  {0:<24} n={1:<8} mean={2:.2f} p50={3:.2f} p90={4:.2f} p99={5:.2f} max={6:.2f}'.format(
+                name, summary['count'], summary['mean'] * 1000, summary['p50'] * 1000,
+                summary['p90'] * 1000, summary['p99'] * 1000, summary['max'] * 1000))
+
+        lines.append('Counters:')
+        for name, value in sorted(snapshot['counters'].iteritems()):
+            lines.append('  {0:<24} {1}'.format(name, value))
+
+        lines.append('Gauges:')
+        for name, value in sorted(snapshot['gauges'].iteritems()):
+            lines.append('  {0:<24} {1}'.format(name, value))
+
+        return '\n'.join(lines)
+
+class StatsServer(object):
+    '''
+    Answers every datagram sent to a local UDP port with the metrics of the node as JSON,
+    from the node's event loop. For instance: echo stats | nc -u -w1 127.0.0.1 <port>
+    '''
+
+    def __init__(self, loop, metrics, port, ip = '127.0.0.1'):
+        self.loop = loop
+        self.metrics = metrics
+        self.addr = (ip, port)
+        self.socket = None
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(self.addr)
+        self.socket.setblocking(False)
+        self.loop.addReader(self.socket, self.readable)
+
+    def readable(self):
+        while True:
+            try:
+                _, addr = self.socket.recvfrom(4096)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            try:
+                self.socket.sendto(json.dumps(self.metrics.snapshot(), sort_keys = True), addr)
+            except socket.error:
+                pass
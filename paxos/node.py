@@ -5,25 +5,58 @@ import socket
 import threading
 import thread
 import time
-import Queue
-import pickle
+import collections
+import codec
 import math
 import random
 from sets import Set
-from messagepump import MessagePump
+from transport import UdpTransport
+from transport import TcpTransport
+from eventloop import EventLoop
 from paxosState import PaxosState
 from paxosState import PaxosRole
 from message import Message
+from message import TYPE_NAMES
 from ballot import Ballot
 from log import Log
+from batcher import Batcher
+from logsync import LogSync
+from reads import Reads
+from rtt import RttEstimator
+from logger import Logger
+from metrics import Metrics
+from metrics import StatsServer
 
 class Node(threading.Thread):
     
-    def __init__(self, localIP, localPort, globalIP, globalPort, config = 'config', proposalCompleted = None):
+    # Timeouts of the leader a forwarded value may wait on it before we propose it ourselves
+    FORWARD_TIMEOUTS = 4
+    
+    # Most seconds we wait for more promises once a quorum has promised
+    PROMISE_GRACE = 0.02
+    
+    # Most seconds we back off before retrying a round which was NACKed or timed out
+    MAX_BACKOFF = 5
+    
+    # Most seconds a busy leader holds back its decisions before announcing them to the
+    # peers that did not learn them from its PREPAREs and ACCEPTs meanwhile
+    COMMIT_INTERVAL = 0.02
+    
+    # Most rounds listed in one COMMIT, which keeps it well within a datagram
+    COMMIT_ROUNDS = 1024
+    
+    def __init__(self, localIP, localPort, globalIP, globalPort, config = 'config', proposalCompleted = None,
+                 stableLeader = False, window = 1, batchSize = 1, batchDelay = 10, flushInterval = 2, flushBatch = 256,
+                 snapshotInterval = 1000, antiEntropyInterval = 5, logLevel = Logger.INFO, statsPort = None,
+                 tcp = False, loop = None, transport = None, shard = None, thrifty = False, allowPickle = False):
         threading.Thread.__init__(self)
         
         self.addr = (globalIP, globalPort)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        
+        # Everything the node reports goes through its logger, which writes from a thread of
+        # its own. Every message sent and received is only logged at the TRACE level
+        name = '{0}:{1}'.format(globalIP, globalPort)
+        self.logger = Logger(name if shard == None else '{0}/{1}'.format(name, shard), logLevel)
 
         # Read config and add the servers to the set
         self.serverSet = Set()
@@ -40,56 +73,171 @@ class Node(threading.Thread):
         # Compute the size of the majority quorum
         self.quorumSize = int(self.numServers/2)+1
         
-        self.log = Log(localIP, localPort)
+        # A node may be one shard of a ShardedNode, running the Paxos rounds of that shard only
+        self.shard = shard
+        self.log = Log(localIP, localPort, flushInterval, flushBatch, snapshotInterval, self.logger, shard)
     
-        # Use a set to maintain gaps with finished Paxos rounds. The next Paxos round will be the
-        # smallest item in the set. If the set is empty, then it is highestRound
-        self.setOfGaps = Set()
-        self.highestRound = 0
-        self.initSetOfGaps()
+        # Round after the highest one we know to be decided. The undecided rounds below it are
+        # the gaps in the log, which the log's round index finds for us
+        self.highestRound = self.log.endRound()
         
         self.paxosStates = {}
+        self.log.onSnapshot = self.compactStates
+        
+        # Proposals of our users that are not decided yet. Up to window of them are in flight,
+        # each in its own round and with its own completion event. The rest wait in the backlog
+        self.window = window
+        self.completions = {}
+        self.backlog = collections.deque()
+        
+        # Round currently carrying each value we propose, along with the value and whether it
+        # was forwarded to us, keyed by the value hash
+        self.proposals = {}
+        
+        # Collects operations into batches of up to batchSize, waiting at most batchDelay ms
+        if batchSize > 1:
+            self.batcher = Batcher(self, batchSize, batchDelay)
+            self.batcher.setDaemon(True)
+        else:
+            self.batcher = None
+        
+        # Multi-Paxos stable leader mode. A node that wins a leader PREPARE keeps its ballot
+        # for all later rounds and sends ACCEPTs directly until it is NACKed.
+        self.stableLeader = stableLeader
+        self.leader = None
+        self.leaderBallot = None
+        self.leaderRound = None
+        
+        # Highest leader ballot we have promised, valid for every round >= promisedRound.
+        # Promises and acceptances made before a restart still bind us
+        self.promisedBallot = self.log.acceptor.promisedBallot
+        self.promisedRound = self.log.acceptor.promisedRound
+        for r, (ballot, value) in self.log.acceptor.rounds.iteritems():
+            if not self.log.isDecided(r):
+                stage = PaxosState.ACCEPTOR_SENT_PROMISE if value == None else PaxosState.ACCEPTOR_ACCEPTED
+                self.paxosStates[r] = PaxosState(r, PaxosRole.ACCEPTOR, stage, ballot, value)
+        
+        # Round in which each of our values went out in an ACCEPT, keyed by the value hash.
+        # Acceptors may have accepted it there, so it is not handed to another node
+        self.offered = {}
+        
+        # Values we forwarded to the leader and are still waiting on, with the timer for
+        # proposing them ourselves, keyed by the value hash
+        self.forwarded = {}
         
-        self.lockValue = None
+        # Rounds we decided as the stable leader, with their values, yet to be announced. Our
+        # next PREPARE or ACCEPT to a peer lists the ones it has not heard of, and the rest go
+        # out on a heartbeat, or right away once we are idle. commitSent holds how far into
+        # the list each peer has been told, counting from commitBase. Peers that forwarded a
+        # value to us, keyed by its hash, are told of its round as soon as it is decided
+        self.commits = []
+        self.commitBase = 0
+        self.commitSent = {}
+        self.commitBallot = None
+        self.commitTimer = None
+        self.forwarders = {}
+        
+        # Pending protocol timers of every undecided round, cancelled once it is decided
+        self.timers = {}
+        
+        # Round trip times to our peers, from which every protocol timeout follows, and the
+        # number of NACKs and timeouts our proposals ran into since one was last decided
+        self.rtt = RttEstimator()
+        self.consecutiveNacks = 0
+        
+        # A thrifty node sends each phase of a proposal to only as many peers as a quorum
+        # needs, the ones with the shortest round trips, and asks the others too when those
+        # time out or one refuses. Peers that failed to answer are suspected of being down,
+        # and left out, until we hear from them again
+        self.thrifty = thrifty
+        self.suspects = Set()
+        
+        # Streams rounds to lagging peers and fetches the rounds we are missing. Every
+        # antiEntropyInterval seconds, it compares our log with a random peer
+        self.sync = LogSync(self)
+        self.antiEntropyInterval = antiEntropyInterval
+        
+        # Serves linearizable reads, from a lease on our leadership or after a read index
+        # request to a quorum, and keeps the lease we granted as an acceptor
+        self.reads = Reads(self)
         
         self.hasFailed = False
         
-        self.queue = Queue.Queue()
-        self.msgReceived = threading.Event()
-        self.msgReceived.clear()
+        # Messages from nodes of older versions are pickled, and unpickling can run arbitrary
+        # code. They are only accepted if allowPickle is set, while such nodes are upgraded
+        self.allowPickle = allowPickle
         
         self.proposalCompleted = proposalCompleted
-    
-        self.messagePump = MessagePump(self.queue, self.msgReceived, owner = self, ip = localIP, port = localPort)
-        self.messagePump.setDaemon(True)
+        
+        # Every message, timer and proposal of this node is handled on this loop, in the
+        # node's own thread. Other threads hand their work over with loop.callSoon. Messages
+        # go over UDP, or over persistent TCP connections to the peers if tcp is set, unless
+        # another transport is given, such as a simulated network
+        self.loop = loop or EventLoop(self.logger)
+        if transport == None:
+            transport = (TcpTransport if tcp else UdpTransport)(self.loop, localIP, localPort, self.logger)
+        self.transport = transport
+        
+        # Phase latencies, protocol counters and queue depths, answered on statsPort if given.
+        # proposedAt holds the time each value of our user was proposed, keyed by its hash
+        self.metrics = Metrics()
+        self.proposedAt = {}
+        self.log.metrics = self.metrics
+        self.addGauges()
+        self.statsServer = StatsServer(self.loop, self.metrics, statsPort) if statsPort else None
     
     
     # Called when thread is started
     def run(self):
-        # Get list of other servers
-        self.messagePump.start()
-        
-        while True:
-            self.msgReceived.wait()
-            while not self.queue.empty():
-                data, addr = self.queue.get()
-                try:
-                    msg = pickle.loads(data)
-                    print '{0}: Received\n{1}'.format(self.addr, msg)
-                    self.processMessage(msg, addr)
-                except Exception as e:
-                    print '{0}: {1}'.format(self.addr, data)
-                    print '{0}: Exception with message\n{1}'.format(self.addr, msg)
-                    print e
-            self.msgReceived.clear()
+        self.startServices()
+        self.loop.run()
+    
+    # Start listening and everything running alongside the loop, without running the loop
+    # itself, which may be shared with other nodes
+    def startServices(self):
+        self.logger.start()
+        self.transport.start(self.datagramReceived)
+        if self.statsServer:
+            self.statsServer.start()
+        if self.batcher:
+            self.batcher.start()
+        self.sync.startAntiEntropy(self.antiEntropyInterval)
+        self.reads.start()
+    
+    # Decode and process a datagram received by the message pump
+    def datagramReceived(self, data, addr):
+        msg = None
+        try:
+            msg = codec.decode(data, self.allowPickle)
+            self.suspects.discard(msg.source)
+            self.metrics.count('received.' + TYPE_NAMES.get(msg.messageType, str(msg.messageType)))
+            self.logger.trace('Received\n{0}', msg)
+            self.processMessage(msg, addr)
+        except Exception as e:
+            self.logger.error('Exception with message from {0}\n{1}\n{2!r}', addr, msg, e)
 
     # Process the message msg received from the address addr
     def processMessage(self, msg, addr):
         # The round corresponding to the message
         r = msg.round
+        
+        # A leader lists the rounds it decided with the PREPAREs and ACCEPTs it sends us
+        if msg.metadata and 'commit' in msg.metadata:
+            self.learnCommits(msg)
 
         # Check if it is a PROPOSE message
         if msg.messageType == Message.PROPOSER_PREPARE:
+            # The round is decided but folded into our snapshot, so the proposer is behind
+            if r < self.log.snapshotRound:
+                nack_msg = Message(msg.round, 
+                                   Message.ACCEPTOR_NACK, 
+                                   self.addr,
+                                   msg.ballot, 
+                                   {'decided': True, 'compacted': True, 'highestballot': None, 'value': None})
+                self.logger.trace('Sending a NACK to {0}', msg.source)
+                self.sendMessage(nack_msg, msg.source)
+                return
+            
             # Check if we have already decided a value for this round
             if r in self.log.transactions:
                 # Return a NACK and the value if this round has already been decided
@@ -98,10 +246,30 @@ class Node(threading.Thread):
                                    self.addr,
                                    msg.ballot, 
                                    {'decided': True, 'highestballot': None, 'value': self.log.transactions[r]})
-                print '{0}: Sending a NACK to {1}'.format(self.addr, msg.source)
+                self.logger.trace('Sending a NACK to {0}', msg.source)
+                self.sendMessage(nack_msg, msg.source)
+                return
+            
+            # We granted another node a lease, or may have before we restarted
+            if self.reads.refuses(msg.source):
+                self.refuse(msg)
+                return
+            
+            # Refuse any ballot lower than the leader ballot we have promised for this round. A
+            # leader PREPARE would cover every round after it, so it must beat our promise
+            # whatever its round
+            leaderPrepare = msg.metadata and msg.metadata.get('leader')
+            promised = self.promisedBallot if leaderPrepare else self.promisedBallotFor(r)
+            if promised and msg.ballot < promised:
+                nack_msg = Message(msg.round, 
+                                   Message.ACCEPTOR_NACK, 
+                                   self.addr,
+                                   msg.ballot, 
+                                   {'highestballot': promised, 'value': None})
+                self.logger.trace('Sending a NACK to {0}', msg.source)
                 self.sendMessage(nack_msg, msg.source)
                 return
-                     
+            
             # Check if we already have sent/received a message for this round 
             if r in self.paxosStates:
                 # Get the state corresponding to the current round
@@ -113,15 +281,19 @@ class Node(threading.Thread):
                                           Message.ACCEPTOR_PROMISE, 
                                           self.addr,
                                           msg.ballot, 
-                                          {'highestballot': state.highestBallot, 'value': state.value})
-                    print '{0}: Sending PROMISE to {1}'.format(self.addr, msg.source)
-                    self.sendMessage(promise_msg, msg.source)
+                                          {'highestballot': state.highestBallot, 'value': state.value,
+                                           'maxround': self.getMaxRound()})
+                    self.logger.trace('Sending PROMISE to {0}', msg.source)
                     
                     # Update the state corresponding to the current round
                     self.paxosStates[r] = PaxosState(r, PaxosRole.ACCEPTOR, 
                                                      PaxosState.ACCEPTOR_SENT_PROMISE, 
                                                      msg.ballot,
                                                      state.value)
+                    if leaderPrepare:
+                        self.promiseLeader(r, msg.ballot)
+                    self.log.acceptor.promise(r, msg.ballot, bool(leaderPrepare),
+                                              self.sendWhenDurable(promise_msg, msg.source))
                 
                 # Send a NACK message if we have already promised to a higher ballot
                 else:
@@ -130,7 +302,7 @@ class Node(threading.Thread):
                                        self.addr,
                                        msg.ballot, 
                                        {'highestballot': state.highestBallot, 'value': state.value})
-                    print '{0}: Sending a NACK to {1}'.format(self.addr, msg.source)
+                    self.logger.trace('Sending a NACK to {0}', msg.source)
                     self.sendMessage(nack_msg, msg.source)
             
             # We haven't touched this round yet. So, accept the proposal and send a PROMISE 
@@ -140,17 +312,21 @@ class Node(threading.Thread):
                                       Message.ACCEPTOR_PROMISE,
                                       self.addr, 
                                       msg.ballot,
-                                      {'highestballot': None, 'value': None})
-                print '{0}: Sending PROMISE to {1}'.format(self.addr, msg.source)
-                self.sendMessage(promise_msg, msg.source)
+                                      {'highestballot': None, 'value': None,
+                                       'maxround': self.getMaxRound()})
+                self.logger.trace('Sending PROMISE to {0}', msg.source)
                 
                 # Update the state corresponding to the current round
                 self.paxosStates[r] = PaxosState(r, PaxosRole.ACCEPTOR, 
                                                  PaxosState.ACCEPTOR_SENT_PROMISE,  
                                                  msg.ballot)
+                if leaderPrepare:
+                    self.promiseLeader(r, msg.ballot)
+                self.log.acceptor.promise(r, msg.ballot, bool(leaderPrepare),
+                                          self.sendWhenDurable(promise_msg, msg.source))
 
         elif msg.messageType == Message.ACCEPTOR_PROMISE:
-            print '{0}: Received a PROMISE from {1}'.format(self.addr, msg.source)
+            self.logger.trace('Received a PROMISE from {0}', msg.source)
             # Ensure we are the proposer for this round 
             if r not in self.paxosStates: return
             
@@ -162,21 +338,52 @@ class Node(threading.Thread):
             # Return if the PROMISE response is not for my current highest ballot
             if state.highestBallot != msg.ballot: return 
             
-            if not state.responses:
-                waitTime = 3
-                timer = threading.Timer(waitTime, self.respondToPromises, [r])
-                timer.start()
+            if 'sent' in state.metadata and msg.source not in state.metadata.get('widened', ()):
+                self.rtt.sample(msg.source, self.loop.time() - state.metadata['sent'])
+            
+            # A straggler promised after we moved on to ACCEPT. Ask it to accept as well, unless
+            # we are thrifty and only ask more peers when the ones we asked fail us
+            if state.stage == PaxosState.PROPOSER_SENT_ACCEPT and not self.thrifty:
+                accept_msg = Message(r, 
+                                     Message.PROPOSER_ACCEPT,
+                                     self.addr,
+                                     state.highestBallot, 
+                                     {'value': state.value})
+                self.sendMessage(accept_msg, msg.source)
+                state.metadata.setdefault('acceptSent', {})[msg.source] = self.loop.time()
+                return
+            
+            if state.stage != PaxosState.PROPOSER_SENT_PROPOSAL: return
 
             # This is a valid PROMISE from one of the servers
             # Add this server to the set of positive responses 
             state.responses.append((msg.source, msg.metadata['highestballot'], msg.metadata['value']))
+            state.metadata['maxround'] = max(state.metadata.get('maxround', -1), msg.metadata.get('maxround', -1))
+            
+            # Move on to ACCEPT as soon as a quorum promised, including ourself. Unless
+            # everyone we asked did, linger for stragglers for a fraction of the time the
+            # quorum took
+            nResponseSet = len(state.responses) + self.ownVote(state)
+            if nResponseSet == self.quorumSize:
+                self.metrics.observe('phase.prepare', self.loop.time() - state.metadata['sent'])
+            if len(state.responses) == len(state.metadata['promise_quorum_servers']):
+                self.respondToPromises(r)
+            elif nResponseSet == self.quorumSize:
+                grace = min(Node.PROMISE_GRACE, (self.loop.time() - state.metadata['sent']) / 2)
+                self.callLater(r, grace, self.respondToPromises, r)
 
         
         elif msg.messageType == Message.ACCEPTOR_NACK:
             # If we receive a NACK indicating that the round has already been decided, update
             # our log and start a new round of Paxos for our original value
             if 'decided' in msg.metadata:
-                if msg.round in self.log.transactions: 
+                if self.log.isDecided(msg.round): 
+                    return
+                
+                # We are too far behind to learn the value, so catch up from the sender's snapshot
+                if 'compacted' in msg.metadata:
+                    self.logger.info('Round {0} is compacted at {1}. Syncing', r, msg.source)
+                    self.logSync(msg.source)
                     return
                 
                 newState = PaxosState(r, PaxosRole.LEARNER, 
@@ -185,11 +392,11 @@ class Node(threading.Thread):
                                       msg.metadata['value'])
                 self.paxosStates[r] = newState
                 self.removeRound(r)
-                self.initPaxos(value = self.lockValue)
                 
                 # Add the result to the log
-                value_type, value_amount, value_hash = msg.metadata['value']
-                self.log.addTransaction(r, value_type, value_amount, value_hash)
+                self.log.addTransaction(r, *msg.metadata['value'])
+                
+                self.completeRound(r, msg.metadata['value'])
           
                 return
 
@@ -197,6 +404,10 @@ class Node(threading.Thread):
             if r not in self.paxosStates: 
                 return 
             
+            # Ignore if we are no longer proposing in this round, or it is decided already
+            if self.paxosStates[r].role != PaxosRole.PROPOSER or self.log.isDecided(r):
+                return
+            
             # Ignore if we receive a NACK for an earlier proposal
             if msg.ballot < self.paxosStates[r].highestBallot:
                 return
@@ -205,30 +416,91 @@ class Node(threading.Thread):
             if self.paxosStates[r].stage == PaxosState.PROPOSER_RECEIVED_NACK:
                 return
             
+            # A thrifty proposer may still get a quorum for this ballot from the peers it did
+            # not ask yet. A lease means nobody else will, so there is no point trying
+            if self.thrifty and 'lease' not in msg.metadata and self.extendQuorum(r, msg.source):
+                return
+            
             # If we receive a generic NACK message from any of the servers, abandon this round
             # because we are never going to succeed with the current ballot number
             self.paxosStates[r].stage = PaxosState.PROPOSER_RECEIVED_NACK
+            
+            # Another node holds a higher ballot, so we are no longer the stable leader
+            if self.leaderBallot and msg.ballot == self.leaderBallot:
+                self.logger.info('NACKed as leader. Stepping down')
+                self.leaderBallot = None
+                self.leader = None
+            
+            # Retry above both our ballot and the ballot the acceptor has promised
+            highestBallot = msg.ballot
+            if msg.metadata.get('highestballot') and msg.metadata['highestballot'] > highestBallot:
+                highestBallot = msg.metadata['highestballot']
+            
+            retryValue = self.paxosStates[r].metadata['value']
+            forwarded = 'forwarded' in self.paxosStates[r].metadata
 
-            waitTime = random.uniform(1.0, 5.0)
-            timer = threading.Timer(waitTime, self.retryPaxos, [r, self.lockValue, msg.ballot])
-            timer.start()
-            print '{0}: Received NACK. Waiting {1} seconds and retrying'.format(self.addr, waitTime)
+            self.metrics.count('nacks')
+            
+            # Another node holds a lease, so it is the leader. Hand our value over to it, or
+            # retry once the lease ran out if the value was forwarded to us, or went out in an
+            # ACCEPT of this round and may be decided in it yet. Nothing is left to do if the
+            # value was decided meanwhile, or moved on to another round
+            if 'lease' in msg.metadata:
+                if self.proposals.get(retryValue[2], (None,))[0] != r:
+                    return
+                holder = msg.metadata.get('leader')
+                offered = self.offered.get(retryValue[2]) == r
+                if self.stableLeader and holder and holder != self.addr and not forwarded and not offered:
+                    self.leader = holder
+                    del self.proposals[retryValue[2]]
+                    self.forwardValue(retryValue)
+                    return
+                waitTime = msg.metadata['lease'] * random.uniform(1.0, 1.1)
+            else:
+                self.consecutiveNacks += 1
+                waitTime = self.getBackoff()
+            self.callLater(r, waitTime, self.retryPaxos, r, retryValue, highestBallot, forwarded)
+            self.logger.debug('Received NACK. Waiting {0} seconds and retrying', waitTime)
                 
         elif msg.messageType == Message.PROPOSER_ACCEPT:
+            if self.reads.refuses(msg.source):
+                self.refuse(msg)
+                return
+            
             # Try to get the state for the acceptor
             if r in self.paxosStates:
                 state = self.paxosStates[r]
+            elif r >= self.log.snapshotRound:
+                # A stable leader skips the PREPARE, so our leader promise stands in for it. If
+                # we promised nothing for the round, we accept as well, as Paxos allows. A
+                # thrifty proposer counts on that when it asks peers it skipped in PREPARE
+                state = PaxosState(r, PaxosRole.ACCEPTOR, 
+                                   PaxosState.ACCEPTOR_SENT_PROMISE, 
+                                   self.promisedBallotFor(r))
             else:
                 return
+            
+            highestBallot = state.highestBallot
+            promised = self.promisedBallotFor(r)
+            if promised and (highestBallot == None or promised > highestBallot):
+                highestBallot = promised
+            
             # Accept the ACCEPT request with the value if we haven't responded to any other 
             # server with a higher ballot
-            if msg.ballot >= state.highestBallot:
+            if highestBallot == None or msg.ballot >= highestBallot:
                 newState = PaxosState(r, PaxosRole.ACCEPTOR, 
                                       PaxosState.ACCEPTOR_ACCEPTED,  
                                       msg.ballot,
                                       msg.metadata['value'])
+                
+                self.paxosStates[r] = newState
+                
+                # Accepting a leader's ACCEPT grants it a lease on its leadership
+                if msg.metadata.get('leader'):
+                    self.leader = msg.source
+                    self.reads.grant(msg.source, msg.ballot)
             
-                print '{0}: Received ACCEPT message. Setting value to {1}'.format(self.addr, msg.metadata['value'])
+                self.logger.trace('Received ACCEPT message. Setting value to {0}', msg.metadata['value'])
                 
                 # Send ACCEPTOR_ACCEPT message to the proposer
                 accepted_msg = Message(msg.round, 
@@ -236,7 +508,8 @@ class Node(threading.Thread):
                                        self.addr,
                                        msg.ballot, 
                                        {'value': msg.metadata['value']})
-                self.sendMessage(accepted_msg, msg.source)
+                self.log.acceptor.accept(r, msg.ballot, msg.metadata['value'],
+                                         self.sendWhenDurable(accepted_msg, msg.source))
                 
 
             # If we received a newer proposal before getting an accept from the original proposer,
@@ -246,12 +519,12 @@ class Node(threading.Thread):
                                    Message.ACCEPTOR_NACK, 
                                    self.addr,
                                    msg.ballot, 
-                                   {'highestballot': state.highestBallot})
-                print '{0}: Sending a NACK to {1}'.format(self.addr, msg.source)
+                                   {'highestballot': highestBallot})
+                self.logger.trace('Sending a NACK to {0}', msg.source)
                 self.sendMessage(nack_msg, msg.source)
 
         elif msg.messageType == Message.ACCEPTOR_ACCEPT:
-            print '{0}: Received an ACCEPT from {1}'.format(self.addr, msg.source)
+            self.logger.trace('Received an ACCEPT from {0}', msg.source)
             # Ensure we are the proposer for this round 
             if r not in self.paxosStates: return
             
@@ -262,6 +535,14 @@ class Node(threading.Thread):
             if state.role != PaxosRole.PROPOSER: return
             # Return if the ACCEPT response is not for my current highest ballot
             if state.highestBallot != msg.ballot: return 
+            # Return if this round has already been decided
+            if state.stage != PaxosState.PROPOSER_SENT_ACCEPT: return
+            
+            sent = state.metadata.get('acceptSent', {}).pop(msg.source, None)
+            if sent != None:
+                self.rtt.sample(msg.source, self.loop.time() - sent)
+                if self.leaderBallot and msg.ballot == self.leaderBallot:
+                    self.reads.granted(msg.source, msg.ballot, sent)
             
             # Assert that the value accepted by the acceptor is the value proposed by the proposer
             assert msg.metadata['value'] == state.value
@@ -271,19 +552,24 @@ class Node(threading.Thread):
             state.responses.append(msg.source)
             
             # Check if we have a quorum. +1 to include ourself
-            if len(state.responses) + 1 >= self.quorumSize:
-                print '{0}: DECIDE Quorum formed'.format(self.addr)
-                print '{0}: Sending DECIDE messages to all ACCEPTORS and LEARNERS'.format(self.addr)
-                
-                # Send DECIDE message to all the other servers
-                decide_msg = Message(msg.round, 
-                                     Message.PROPOSER_DECIDE,
-                                     self.addr,
-                                     state.highestBallot, 
-                                     {'value': state.value})
+            if len(state.responses) + self.ownVote(state) >= self.quorumSize:
+                self.logger.trace('DECIDE Quorum formed')
+                self.metrics.observe('phase.accept', self.loop.time() - state.metadata['acceptStart'])
                 
-                for server in self.serverSet:
-                    self.sendMessage(decide_msg, server)
+                # As the stable leader, our peers learn the decision with our next messages
+                # to them. Otherwise send DECIDE message to all the other servers
+                if self.stableLeader and state.highestBallot == self.leaderBallot:
+                    self.addCommit(r, state.value)
+                else:
+                    self.logger.trace('Sending DECIDE messages to all ACCEPTORS and LEARNERS')
+                    decide_msg = Message(msg.round, 
+                                         Message.PROPOSER_DECIDE,
+                                         self.addr,
+                                         state.highestBallot, 
+                                         {'value': state.value})
+                    
+                    for server in self.serverSet:
+                        self.sendMessage(decide_msg, server)
 
                 # Update the state corresponding to sending the DECIDES
                 newState = PaxosState(r, PaxosRole.PROPOSER, 
@@ -294,24 +580,19 @@ class Node(threading.Thread):
                 
                 # Update the state to reflect that this round has been DECIDED
                 self.removeRound(r)
+                self.consecutiveNacks = 0
 
                 # Add the result to the log
-                if isinstance(msg.metadata['value'], list):
-                    value_type, value_amount, value_hash = self.getDecideValue(msg.metadata['value'])
-                else:
-                    value_type, value_amount, value_hash = msg.metadata['value']
-                self.log.addTransaction(r, value_type, value_amount, value_hash)
+                self.log.addTransaction(r, *self.getDecideValue(msg.metadata['value']))
           
                 # If the value we just decided on is the value our user is waiting on, then we are done
                 # Else, we need to start another round to get consensus on our original value
-                if (value_type, value_amount, value_hash) == self.lockValue or self.lockValue in msg.metadata['value']:
-                    self.proposalCompleted.set()
-                else:
-                    self.initPaxos(value = self.lockValue)
+                self.completeRound(r, msg.metadata['value'])
+                self.scheduleCommits()
                 
 
         elif msg.messageType == Message.PROPOSER_DECIDE:
-            print '{0}: Received a DECIDE message'.format(self.addr)
+            self.logger.trace('Received a DECIDE message')
             if r in self.paxosStates:
                 # Get the state corresponding to the current round
                 state = self.paxosStates[r]
@@ -334,130 +615,347 @@ class Node(threading.Thread):
             self.removeRound(r)
                 
             # Add the result to the log
-            if isinstance(msg.metadata['value'], list):
-                value_type, value_amount, value_hash = self.getDecideValue(msg.metadata['value'])
-            else:
-                value_type, value_amount, value_hash = msg.metadata['value']
-            self.log.addTransaction(r, value_type, value_amount, value_hash)
+            self.log.addTransaction(r, *self.getDecideValue(msg.metadata['value']))
 
             # If some other proposer decided on our value, then release the application lock
-            # Else, see if there is any state still tracking our original value. If not, start a fresh 
-            # round of paxos for our original value
-            if not self.lockValue: 
-                return
+            # Else, if this round was carrying one of our values, start a fresh round for it
+            self.completeRound(r, msg.metadata['value'])
+        
+        elif msg.messageType == Message.PROPOSER_COMMIT:
+            # Its rounds were learned along with those listed on PREPAREs and ACCEPTs
+            self.logger.trace('Received a COMMIT message from {0}', msg.source)
+
+        elif msg.messageType == Message.CLIENT_FORWARD:
+            self.logger.trace('Received a forwarded value from {0}', msg.source)
+            value = msg.metadata['value']
             
-            if (value_type, value_amount, value_hash) == self.lockValue or self.lockValue in msg.metadata['value']:
-                self.proposalCompleted.set()
-            else:
-                for key in self.paxosStates:
-                    if self.paxosStates[key].value == self.lockValue or self.lockValue in self.paxosStates[key].value:
-                        return
-                if not self.proposalCompleted.isSet():
-                    self.initPaxos(value = self.lockValue)
+            # Drop values which are already decided or already being proposed by us
+            if value[2] in self.log.hashes or value[2] in self.proposals:
+                return
+            self.forwarders[value[2]] = msg.source
+            self.beginRound(value = value, forwarded = True)
 
         elif msg.messageType == Message.LOG_SYNC_REQUEST:
-            print '{0}: Received a SYNC REQUEST message from {1}'.format(self.addr, msg.source)
-            msg_log = msg.metadata['log']
-            response = {}
-            for key in self.log.transactions:
-                if key not in msg_log:
-                    response[key] = self.log.transactions[key]
-            if response:
-                print '{0}: Sent a SYNC RESPONSE message to {1}'.format(self.addr, msg.source)
-                self.logSync(response, msg.source, Message.LOG_SYNC_RESPONSE)
-            
-            for key in msg_log:
-                if key not in self.log.transactions:
-                    self.log.addTransaction(key, msg_log[key][0], msg_log[key][1], msg_log[key][2])
-            
-            # Don't forget to reinit the set of gaps
-            self.initSetOfGaps()
+            self.logger.trace('Received a SYNC REQUEST message from {0}', msg.source)
+            self.sync.processRequest(msg)
                 
         elif msg.messageType == Message.LOG_SYNC_RESPONSE:
-            print '{0}: Received a SYNC RESPONSE message from {1}'.format(self.addr, msg.source)
-            msg_log = msg.metadata['log']
-            for key in msg_log:
-                if key not in self.log.transactions:
-                    self.log.addTransaction(key, msg_log[key][0], msg_log[key][1], msg_log[key][2])
-            
-            # Don't forget to reinit the set of gaps
-            self.initSetOfGaps()
-                
-            
+            self.logger.trace('Received a SYNC RESPONSE message from {0}', msg.source)
+            self.sync.processChunk(msg)
+        
+        elif msg.messageType == Message.LOG_SYNC_ACK:
+            self.sync.processAck(msg)
+        
+        elif msg.messageType == Message.LOG_DIGEST:
+            self.sync.processDigest(msg)
+        
+        elif msg.messageType == Message.READ_INDEX_REQUEST:
+            self.reads.processRequest(msg)
+        
+        elif msg.messageType == Message.READ_INDEX_RESPONSE:
+            self.reads.processResponse(msg)
+
+    # NACK a PREPARE or ACCEPT of msg.source, which someone else holds a lease against, with
+    # the holder and the seconds left on its lease. We stay silent while we may have granted
+    # one we do not remember
+    def refuse(self, msg):
+        if not self.reads.holderBallot:
+            return
+        
+        nack_msg = Message(msg.round, 
+                           Message.ACCEPTOR_NACK, 
+                           self.addr,
+                           msg.ballot, 
+                           {'highestballot': self.reads.holderBallot, 'value': None,
+                            'lease': self.reads.expiry - self.loop.time(), 'leader': self.reads.holder})
+        self.logger.trace('Sending a NACK to {0}, which another node holds a lease against', msg.source)
+        self.sendMessage(nack_msg, msg.source)
+
+    # Submit an operation of our user from any thread. With batching enabled it shares a
+    # round with other operations, otherwise it gets a round of its own. Returns its
+    # completion event
+    def submit(self, value):
+        if self.batcher:
+            return self.batcher.submit(value)
+        
+        completed = threading.Event()
+        self.loop.callSoon(self.initPaxos, None, value, None, completed)
+        return completed
+    
+    # Read the log linearizably from any thread. query(log) runs on our loop once the log
+    # holds every operation decided before the call. Returns the Read, whose value is the
+    # result of the query once it completed
+    def read(self, query, completed = None):
+        return self.reads.read(query, completed)
+
+    # Initiate Paxos for a value of our user. Returns an event which is set once the value
+    # is decided. If the window of outstanding proposals is full, the value waits its turn
+    def initPaxos(self, r = None, value = None, ballot = None, completed = None):
+        if completed == None:
+            completed = threading.Event()
+        self.proposedAt.setdefault(value[2], self.loop.time())
+        
+        if len(self.completions) >= self.window:
+            self.logger.debug('{0} proposals in flight. Queueing value', len(self.completions))
+            self.backlog.append((r, value, ballot, completed))
+        else:
+            self.startProposal(r, value, ballot, completed)
+        
+        self.updateWindow()
+        return completed
+    
+    def startProposal(self, r, value, ballot, completed):
+        self.completions[value[2]] = completed
+        
+        # In stable leader mode, hand the value to the leader instead of competing with it
+        if self.stableLeader and r == None and not self.leaderBallot and self.leader and self.leader != self.addr:
+            self.forwardValue(value)
+            return
+        
+        self.beginRound(r, value, ballot)
+    
+    # Start queued proposals while the window has room, and tell the application whether
+    # it can propose again without queueing
+    def updateWindow(self):
+        while self.backlog and len(self.completions) < self.window:
+            r, value, ballot, completed = self.backlog.popleft()
+            self.startProposal(r, value, ballot, completed)
+        
+        if not self.proposalCompleted:
+            return
+        if len(self.completions) < self.window:
+            self.proposalCompleted.set()
+        else:
+            self.proposalCompleted.clear()
+    
+    # The decided value of our user is on disk, so the user can move on
+    def releaseProposal(self, h):
+        if h in self.completions:
+            self.completions.pop(h).set()
+        self.updateWindow()
+    
+    # Our value h was decided in a round we did not learn it from, such as a round in a
+    # snapshot we installed. Release its proposal once that round is durable here
+    def releaseDecided(self, h):
+        if h in self.completions:
+            self.log.whenDurable(self.log.hashes[h], lambda: self.loop.callSoon(self.releaseProposal, h))
+    
+    # Round r was decided with value. Release every proposal the value carries and, if the
+    # round was carrying one of our values which lost, propose that value in a fresh round
+    def completeRound(self, r, value):
+        decidedHashes = self.getValueHashes(value)
+        
+        for h in decidedHashes:
+            if h in self.proposedAt:
+                self.metrics.observe('phase.propose-decide', self.loop.time() - self.proposedAt.pop(h))
+            if h in self.forwarded:
+                self.forwarded.pop(h)[1].cancel()
+            self.forwarders.pop(h, None)
+            self.proposals.pop(h, None)
+            self.offered.pop(h, None)
+            if h in self.completions:
+                self.log.whenDurable(r, lambda h = h: self.loop.callSoon(self.releaseProposal, h))
+        
+        # Our state for the round may already be gone, for instance when we promised a higher
+        # ballot of another proposer, so look the value up by round. A NOOP which lost has
+        # done its job, since the round is decided either way
+        for h, (round, ownValue, forwarded) in self.proposals.items():
+            if round == r:
+                del self.proposals[h]
+                self.offered.pop(h, None)
+                if ownValue[0] == Log.NOOP:
+                    continue
+                if h not in self.log.hashes:
+                    self.beginRound(value = ownValue, forwarded = forwarded)
+                else:
+                    self.releaseDecided(h)
+        
+        self.updateWindow()
+        self.reads.serve()
 
-    # Initiate Paxos with a proposal to a quorum of servers
-    def initPaxos(self, r = None, value = None, ballot = None):
+    # Start a round for the given value, with a proposal to a quorum of servers. Forwarded
+    # values belong to another node's user, so no completion event is waiting on them
+    def beginRound(self, r = None, value = None, ballot = None, forwarded = False):
         if r == None:
             r = self.getNextRound()
+        
+        self.proposals[value[2]] = (r, value, forwarded)
+        
+        metadata = {'promise_quorum_servers':Set(), 'value': value}
+        if forwarded:
+            metadata['forwarded'] = True
+        
+        # We refuse ourselves just as any other proposer while we granted someone else a
+        # lease, or restarted too recently to know, and then do not count towards the quorum
+        if self.reads.refuses(self.addr):
+            metadata['refusedSelf'] = True
+        quorum = self.getQuorum(0 if 'refusedSelf' in metadata else 1) if self.thrifty else self.serverSet
+        
+        # We are the stable leader and nobody has touched this round yet, so skip PREPARE
+        if ballot == None and self.leaderBallot and r >= self.leaderRound and r not in self.paxosStates:
+            self.logger.debug('Initiating Paxos for round {0} as leader', r)
+            self.paxosStates[r] = PaxosState(r, PaxosRole.PROPOSER, 
+                                             PaxosState.PROPOSER_SENT_ACCEPT,  
+                                             self.leaderBallot,
+                                             value, 
+                                             metadata)
+            accept_msg = Message(r, 
+                                 Message.PROPOSER_ACCEPT,
+                                 self.addr,
+                                 self.leaderBallot, 
+                                 {'value': value, 'leader': True})
+            self.reads.grant(self.addr, self.leaderBallot)
+            metadata['accept'] = accept_msg
+            metadata['accept_quorum_servers'] = Set(quorum)
+            metadata['acceptSent'] = {}
+            metadata['acceptStart'] = self.loop.time()
+            self.log.acceptor.accept(r, self.leaderBallot, value, 
+                                     self.sendPhaseWhenDurable(r, accept_msg, metadata['accept_quorum_servers']))
+            self.callLater(r, self.getQuorumTimeout(), self.proposalTimeout, r, value, self.leaderBallot, 
+                           PaxosState.PROPOSER_SENT_ACCEPT, forwarded)
+            return
+            
+        # As leader, a round below leaderRound still needs a PREPARE but keeps our ballot
+        if ballot == None and self.leaderBallot and r not in self.paxosStates:
+            ballot = self.leaderBallot
             
         if ballot == None:
             ballot = Ballot(self.addr[0], self.addr[1])
             if r in self.paxosStates:
-                print '{0}: Found a previous ballot for this r. Setting current ballot greater than prev ballot.'.format(self.addr)
+                self.logger.debug('Found a previous ballot for this r. Setting current ballot greater than prev ballot.')
                 ballot.set_n(self.paxosStates[r].highestBallot.n+1)
+        
+        # Outbid the leader ballot we have promised, or the acceptors will NACK us
+        promised = self.promisedBallotFor(r)
+        if promised and ballot < promised:
+            ballot = Ballot(self.addr[0], self.addr[1], promised.n+1)
 
-        self.lockValue = value
-
-        prop_msg = Message(r, Message.PROPOSER_PREPARE, self.addr, ballot)
+        if self.stableLeader:
+            prop_msg = Message(r, Message.PROPOSER_PREPARE, self.addr, ballot, {'leader': True})
+        else:
+            prop_msg = Message(r, Message.PROPOSER_PREPARE, self.addr, ballot)
         
-        print '{0}: Initiating Paxos for round {1}'.format(self.addr, r)
+        self.logger.debug('Initiating Paxos for round {0}', r)
+        metadata['prepare'] = prop_msg
+        metadata['sent'] = self.loop.time()
         self.paxosStates[r] = PaxosState(r, PaxosRole.PROPOSER, 
                                          PaxosState.PROPOSER_SENT_PROPOSAL,  
                                          ballot,
                                          value, 
-                                         {'promise_quorum_servers':Set()})
+                                         metadata)
 
-        for server in self.serverSet:
-            self.sendMessage(prop_msg, server)
-            if 'promise_quorum_servers' in self.paxosStates[r].metadata:
-                self.paxosStates[r].metadata['promise_quorum_servers'].add(server)
-            else:
-                self.paxosStates[r].metadata['promise_quorum_servers'] = Set([server])
+        self.paxosStates[r].metadata['promise_quorum_servers'] |= Set(quorum)
+        self.log.acceptor.promise(r, ballot, self.stableLeader, self.sendPhaseWhenDurable(r, prop_msg, quorum))
+        
+        self.callLater(r, self.getQuorumTimeout(), self.proposalTimeout, r, value, ballot, 
+                       PaxosState.PROPOSER_SENT_PROPOSAL, forwarded)
                 
-#         t = threading.Thread(name='promise_thread', 
-#                              target=self.extendPromiseQuorum, 
-#                              args=[r, prop_msg, 5])
-#         t.start()
+    # Callback for a record of the acceptor log, which sends msg to addr from the loop once
+    # the record is durable. A PROMISE or ACCEPTED going out before could be broken by a restart
+    def sendWhenDurable(self, msg, addr):
+        return lambda: self.loop.callSoon(self.sendMessage, msg, addr)
+    
+    # The same for the PREPARE or ACCEPT of our proposal in round r, since we count our own
+    # promise or acceptance towards its quorum
+    def sendPhaseWhenDurable(self, r, msg, servers):
+        return lambda: self.loop.callSoon(self.sendPhase, r, msg, list(servers))
+    
+    def sendPhase(self, r, msg, servers):
+        state = self.paxosStates.get(r)
+        if not state or state.role != PaxosRole.PROPOSER or state.highestBallot != msg.ballot:
+            return
+        
+        if msg.messageType == Message.PROPOSER_ACCEPT:
+            h = state.metadata['value'][2]
+            if h in self.getValueHashes(msg.metadata['value']):
+                self.offered[h] = r
         
-    # Try more servers periodically if our initial attempt at getting a quorum was unsuccessful
+        for server in servers:
+            self.sendMessage(msg, server)
+            if msg.messageType == Message.PROPOSER_ACCEPT:
+                state.metadata['acceptSent'][server] = self.loop.time()
     
-    def extendPromiseQuorum(self, round, prop_msg, sleep_time = 5):
-        while True:
-            time.sleep(sleep_time)
-            
-            # The original paxos for this round failed/timed-out. Stop sending more promises for this round.
-            if round not in self.paxosStates: 
-                return
-            
-            # Return if the value gets decided by some other server
-            if round in self.log.transactions: 
-                return
-            
-            state = self.paxosStates[round]
-            
-            # If the proposer received a NACK and abandoned our corresponding round, we should also abandon
-            if state.stage == PaxosState.PROPOSER_RECEIVED_NACK: 
-                return
-            
-            if state.stage == PaxosState.PROPOSER_SENT_PROPOSAL:
-                diff_set = self.serverSet - state.metadata['promise_quorum_servers']
-                if not diff_set: return
-                
-                server = diff_set.pop()
-                state.metadata['promise_quorum_servers'].add(server)
-
-                print '{0}: Did not find a PROMISE quorum yet. Trying more servers for round {1}.'.format(self.addr, round)
-                prop_msg.ballot = state.highestBallot
-                self.sendMessage(prop_msg, server)
-            else: 
-                return
-#                 thread.exit()
+    # Send our value to the stable leader and fall back to proposing it ourselves if the
+    # leader does not decide it in time
+    def forwardValue(self, value):
+        self.logger.debug('Forwarding value to leader {0}', self.leader)
+        forward_msg = Message(None, 
+                              Message.CLIENT_FORWARD,
+                              self.addr,
+                              None, 
+                              {'value': value})
+        self.sendMessage(forward_msg, self.leader)
+        
+        timeout = Node.FORWARD_TIMEOUTS * self.rtt.timeout(self.leader)
+        timer = self.loop.callLater(timeout, self.forwardTimeout, value)
+        self.forwarded[value[2]] = (value, timer)
+    
+    def forwardTimeout(self, value):
+        if value[2] not in self.forwarded: 
+            return
+        
+        del self.forwarded[value[2]]
+        if value[2] in self.log.hashes:
+            self.releaseDecided(value[2])
+            return
+        
+        self.logger.info('Leader {0} did not decide our value. Proposing it ourselves', self.leader)
+        self.leader = None
+        self.beginRound(value = value)
+        
+    # Ask the peers we left out of the current phase of our proposal in round r, since the
+    # ones we asked timed out or one of them refused. Returns whether the ballot of the round
+    # can still get a quorum, in which case the round waits for it rather than retrying
+    def extendQuorum(self, r, refused = None):
+        state = self.paxosStates[r]
+        if state.stage == PaxosState.PROPOSER_SENT_PROPOSAL:
+            msg, asked = state.metadata['prepare'], state.metadata['promise_quorum_servers']
+            answered = Set(source for source, _, _ in state.responses)
+        elif state.stage == PaxosState.PROPOSER_SENT_ACCEPT and 'accept' in state.metadata:
+            msg, asked = state.metadata['accept'], state.metadata['accept_quorum_servers']
+            answered = Set(state.responses)
+        else:
+            return False
+        
+        refusals = state.metadata.setdefault('refused', Set())
+        if refused:
+            refusals.add(refused)
+        if self.numServers - len(refusals) - (1 - self.ownVote(state)) < self.quorumSize:
+            return False
+        
+        others = self.serverSet - asked
+        if not others:
+            return refused != None
+        
+        if refused == None:
+            self.suspects |= asked - answered - refusals
+        self.logger.debug('No quorum for round {0} from the peers we asked. Asking {1} more', r, len(others))
+        self.metrics.count('quorum.extended')
+        
+        widened = state.metadata.setdefault('widened', Set())
+        for server in others:
+            self.sendMessage(msg, server)
+            asked.add(server)
+            widened.add(server)
+            if msg.messageType == Message.PROPOSER_ACCEPT:
+                state.metadata['acceptSent'][server] = self.loop.time()
+        
+        # The peers we just asked get a whole timeout to answer
+        timeout = self.getQuorumTimeout()
+        state.metadata['deadline'] = self.loop.time() + timeout
+        self.callLater(r, timeout, self.proposalTimeout, r, state.metadata['value'], 
+                       state.highestBallot, state.stage, 'forwarded' in state.metadata)
+        return True
 
     def respondToPromises(self, r):
         state = self.paxosStates[r]
         
-        nResponseSet = len(state.responses) + 1
-        # Check if we have a quorum. +1 to include ourself
+        # The round moved on (retried, decided or taken over by the leader) while we waited
+        if state.stage != PaxosState.PROPOSER_SENT_PROPOSAL:
+            return
+        
+        nResponseSet = len(state.responses) + self.ownVote(state)
+        # Check if we have a quorum, including ourself
         if nResponseSet >= self.quorumSize:
             # Get the value corresponding to the highest ballot
             highestBallot, highestValue = None, None
@@ -479,13 +977,18 @@ class Node(threading.Thread):
                 maxVotes = listOfValues.count(highestValue)
                 
                 if maxVotes + (self.numServers - nResponseSet) < self.quorumSize:
-                    newValue = [val for val in Set(listOfValues) if val[0] == self.lockValue[0]]
+                    ownValue = state.metadata['value']
+                    # Values merged earlier are lists, which never match a single value
+                    single = Set(val for val in listOfValues if not isinstance(val, list))
+                    newValue = [val for val in single if val[0] == ownValue[0]]
                     if newValue:
-                        newValue.append(self.lockValue)
+                        # Our value may be one of those already, and must not be decided twice
+                        if ownValue not in single:
+                            newValue.append(ownValue)
                         highestValue = newValue
             
-            print '{0}: PROMISE Quorum formed'.format(self.addr)
-            print '{0}: Sending ACCEPT messages to all ACCEPTORS'.format(self.addr)
+            self.logger.trace('PROMISE Quorum formed')
+            self.logger.trace('Sending ACCEPT messages to all ACCEPTORS')
             
             # If all the acceptors return None values, send ACCEPT messages with the value we are
             # trying to set. Else, set value to the highest value returned by the acceptors.
@@ -497,110 +1000,379 @@ class Node(threading.Thread):
                                  self.addr,
                                  state.highestBallot, 
                                  {'value': highestValue})
+            state.metadata['refusedSelf'] = self.reads.refuses(self.addr)
+            if self.stableLeader:
+                accept_msg.metadata['leader'] = True
+                self.reads.grant(self.addr, state.highestBallot)
             
-            for (source, _, _) in self.paxosStates[r].responses:
-                self.sendMessage(accept_msg, source)
-
-            # Update the state corresponding to sending the accepts
+            # Update the state corresponding to sending the accepts before sending them, so
+            # that fast replies find the round waiting on ACCEPTs
             newState = PaxosState(r, PaxosRole.PROPOSER, 
                                   PaxosState.PROPOSER_SENT_ACCEPT,  
                                   state.highestBallot,
-                                  highestValue)
+                                  highestValue, 
+                                  state.metadata)
             self.paxosStates[r] = newState
+            
+            # A thrifty proposer asks as few of the peers that promised as a quorum needs, the
+            # first ones to promise
+            acceptors = [source for (source, _, _) in state.responses]
+            if self.thrifty:
+                acceptors = acceptors[:self.quorumSize - self.ownVote(state)]
+            
+            state.metadata['accept'] = accept_msg
+            state.metadata['accept_quorum_servers'] = Set(acceptors)
+            state.metadata['acceptSent'] = {}
+            state.metadata['acceptStart'] = self.loop.time()
+            self.log.acceptor.accept(r, state.highestBallot, highestValue,
+                                     self.sendPhaseWhenDurable(r, accept_msg, acceptors))
+            
+            self.callLater(r, self.getQuorumTimeout(), self.proposalTimeout, r, state.metadata['value'], 
+                           state.highestBallot, PaxosState.PROPOSER_SENT_ACCEPT, 'forwarded' in state.metadata)
+            
+            # A quorum promised our ballot for every later round. Rounds beyond anything the
+            # quorum has seen can skip PREPARE from now on
+            if self.stableLeader:
+                self.logger.info('Elected leader with ballot {0}', state.highestBallot)
+                self.leader = self.addr
+                self.leaderBallot = state.highestBallot
+                self.leaderRound = max(r, state.metadata.get('maxround', -1), self.getMaxRound()) + 1
+                self.promisedBallot = state.highestBallot
+                self.promisedRound = r
+
+    # Hashes of the values of all users that a decided value carries
+    def getValueHashes(self, value):
+        if isinstance(value, list):
+            hashes = Set()
+            for v in value:
+                hashes |= self.getValueHashes(v)
+            return hashes
+        
+        hashes = Set([value[2]])
+        if value[0] == Log.BATCH:
+            hashes |= Set([op[2] for op in value[1]])
+        return hashes
 
     def getDecideValue(self, listVals):
         if not isinstance(listVals, list): 
             return listVals
         
-        z = zip(*listVals)
-        assert len(Set(z[0])) == 1
-        return (z[0][0], sum(z[1]), hash(z[2]))
+        # Merge the values into one batch, so every operation keeps its own hash in the log
+        ops = []
+        for value in listVals:
+            if value[0] == Log.BATCH:
+                ops.extend(value[1])
+            else:
+                ops.append(value)
+        return (Log.BATCH, tuple(ops), hash(tuple(value[2] for value in listVals)))
+        
+    # A phase of our proposal of value in round r did not hear from a quorum in time. Unless
+    # the round moved on, retry it with a higher ballot. This also covers rounds where
+    # we promised another proposer which then went quiet
+    def proposalTimeout(self, r, value, ballot, stage, forwarded):
+        if self.proposals.get(value[2], (None,))[0] != r:
+            self.fillRound(r, Ballot(self.addr[0], self.addr[1], ballot.n + 1))
+            return
+        
+        state = self.paxosStates.get(r)
+        if state and state.role == PaxosRole.PROPOSER:
+            if state.highestBallot != ballot or state.stage != stage:
+                return
+            if self.loop.time() < state.metadata.get('deadline', 0):
+                return
+            if self.thrifty and self.extendQuorum(r):
+                return
+            state.stage = PaxosState.PROPOSER_RECEIVED_NACK
+        
+        self.logger.debug('No quorum for round {0} in time. Retrying', r)
+        self.metrics.count('timeouts')
+        if self.leaderBallot and ballot == self.leaderBallot:
+            self.logger.info('Stepping down as leader')
+            self.leaderBallot = None
+            self.leader = None
+        
+        highestBallot = ballot
+        if state and state.highestBallot and state.highestBallot > highestBallot:
+            highestBallot = state.highestBallot
+        
+        self.consecutiveNacks += 1
+        self.callLater(r, self.getBackoff(), self.retryPaxos, r, value, highestBallot, forwarded)
         
     #After receiving a NACK, retry with the lowest available round and the failed value
-    def retryPaxos(self, round, failedValue, highestBallot):
+    def retryPaxos(self, round, failedValue, highestBallot, forwarded = False):
 #         newRound = self.getNextRound()
         ballot = Ballot(self.addr[0], self.addr[1], highestBallot.n+1)
-        print '{0}: Retrying round {1} with new ballot {2}'.format(self.addr, round, ballot)
-        self.initPaxos(round, failedValue, ballot)
+        
+        # The value was decided meanwhile, or moved on to another round
+        if self.proposals.get(failedValue[2], (None,))[0] != round:
+            self.fillRound(round, ballot)
+            return
+        
+        self.logger.debug('Retrying round {0} with new ballot {1}', round, ballot)
+        self.metrics.count('retries')
+        self.beginRound(round, failedValue, ballot, forwarded)
     
-    # Get the next available round number 
+    # Our value left round r for another round, but others may have accepted something in r
+    # and nobody else may drive it. The log cannot apply past an undecided round, so decide
+    # it with a NOOP, which takes over any value accepted there instead
+    def fillRound(self, r, ballot):
+        if self.log.isDecided(r) or r in Set(round for round, _, _ in self.proposals.itervalues()):
+            return
+        
+        self.logger.debug('Filling abandoned round {0} with a NOOP', r)
+        self.beginRound(r, (Log.NOOP, 0.0, random.getrandbits(63)), ballot, forwarded = True)
+    
+    # Get the lowest undecided round which none of our proposals is using. Skipping the
+    # rounds in flight takes O(log n) each, and there are at most window of them
     def getNextRound(self):
-        if not self.setOfGaps: 
-            return self.highestRound
-        else:
-            return min(self.setOfGaps)
+        inFlight = Set(round for round, _, _ in self.proposals.itervalues())
+        r = self.log.firstGap()
+        while r in inFlight:
+            r = self.log.nextGap(r + 1)
+        return r
+        
+    # Apply the decisions of several rounds, given as (round, value) pairs, to the log at once
+    def learn(self, entries):
+        entries = [(r, value) for r, value in entries if not self.log.isDecided(r)]
+        for r, value in entries:
+            self.paxosStates.pop(r, None)
+            self.removeRound(r)
+        
+        self.log.addTransactions([(r, self.getDecideValue(value)) for r, value in entries])
+        for r, value in entries:
+            self.completeRound(r, value)
+    
+    # The rounds msg lists were decided with its ballot, so in each of them we accepted the
+    # decided value if we accepted any value with that ballot. We fetch the others from the
+    # sender
+    def learnCommits(self, msg):
+        entries = []
+        missing = False
+        for r in msg.metadata['commit']:
+            state = self.paxosStates.get(r)
+            if state and state.stage == PaxosState.ACCEPTOR_ACCEPTED and state.highestBallot == msg.ballot:
+                entries.append((r, state.value))
+            elif not self.log.isDecided(r):
+                missing = True
         
+        self.learn(entries)
+        if missing and msg.source not in self.sync.sessions:
+            self.logSync(msg.source)
+    
+    # Keep round r, which we decided with value as the stable leader, for our peers to learn.
+    # A peer which forwarded the value to us is waiting on it, so it gets a DECIDE right away
+    def addCommit(self, r, value):
+        if self.commitBallot != self.leaderBallot:
+            self.announceCommits()
+            self.commits = []
+            self.commitBase = 0
+            self.commitSent = dict((server, 0) for server in self.serverSet)
+            self.commitBallot = self.leaderBallot
+        self.commits.append((r, value))
+        
+        forwarders = Set(self.forwarders.pop(h) for h in self.getValueHashes(value) if h in self.forwarders)
+        if forwarders:
+            decide_msg = Message(r, Message.PROPOSER_DECIDE, self.addr, self.commitBallot, {'value': value})
+            for server in forwarders:
+                self.sendMessage(decide_msg, server)
+    
+    # Announce our decisions right away once we have nothing in flight, since no PREPARE or
+    # ACCEPT will carry them soon. Otherwise on the next heartbeat
+    def scheduleCommits(self):
+        if not self.commits:
+            return
+        if not self.proposals and not self.backlog:
+            self.announceCommits()
+        elif not self.commitTimer:
+            self.commitTimer = self.loop.callLater(Node.COMMIT_INTERVAL, self.commitHeartbeat)
+    
+    def commitHeartbeat(self):
+        self.commitTimer = None
+        self.announceCommits()
+    
+    # Tell every peer the decisions it has not heard of yet, a single one with a DECIDE. More
+    # of them are listed by round in COMMITs, as on our PREPAREs and ACCEPTs, since the peer
+    # accepted their values already or else fetches them with a log sync
+    def announceCommits(self):
+        end = self.commitBase + len(self.commits)
+        pending = dict((server, self.commits[self.commitSent.get(server, end) - self.commitBase:])
+                       for server in self.serverSet)
+        self.commitSent = dict((server, end) for server in self.serverSet)
+        self.commitBase = end
+        self.commits = []
+        
+        for server, entries in pending.iteritems():
+            if len(entries) == 1:
+                r, value = entries[0]
+                self.sendMessage(Message(r, Message.PROPOSER_DECIDE, self.addr, self.commitBallot, {'value': value}), server)
+                continue
+            
+            for i in xrange(0, len(entries), Node.COMMIT_ROUNDS):
+                rounds = [r for r, _ in entries[i:i + Node.COMMIT_ROUNDS]]
+                self.sendMessage(Message(None, Message.PROPOSER_COMMIT, self.addr, self.commitBallot, {'commit': rounds}), server)
+    
+    # List the rounds we decided that addr has not heard of on a PREPARE or ACCEPT of ours
+    # with the same ballot, which tells addr what was decided in them
+    def attachCommits(self, msg, addr):
+        if msg.messageType not in (Message.PROPOSER_PREPARE, Message.PROPOSER_ACCEPT) or msg.ballot != self.commitBallot:
+            return msg
+        
+        end = self.commitBase + len(self.commits)
+        sent = self.commitSent.get(addr, end)
+        if sent >= end:
+            return msg
+        
+        self.commitSent[addr] = end
+        self.metrics.count('commits.piggybacked', end - sent)
+        metadata = dict(msg.metadata or {}, commit = [r for r, _ in self.commits[sent - self.commitBase:]])
+        return Message(msg.round, msg.messageType, msg.source, msg.ballot, metadata)
+    
     # Update the rounds when a DECIDE has been made
     def removeRound(self, r):
-        if r in self.setOfGaps: 
-            self.setOfGaps.remove(r)
-        elif r == self.highestRound:
-            self.highestRound += 1
+        self.cancelTimers(r)
+        self.highestRound = max(self.highestRound, r + 1)
+    
+    # Run callback(*args) on our loop after delay seconds, unless round r is decided first
+    def callLater(self, r, delay, callback, *args):
+        timer = self.loop.callLater(delay, callback, *args)
+        self.timers.setdefault(r, []).append(timer)
+        return timer
+    
+    def cancelTimers(self, r):
+        for timer in self.timers.pop(r, []):
+            timer.cancel()
+    
+    # Seconds a phase of a proposal may wait on a quorum of our peers before we retry it
+    def getQuorumTimeout(self):
+        return self.rtt.quorumTimeout(self.serverSet, self.quorumSize - 1)
+    
+    # Seconds to wait before retrying a round. The wait doubles with every NACK or timeout
+    # in a row, and is jittered so that dueling proposers drift apart
+    def getBackoff(self):
+        backoff = self.getQuorumTimeout() * 2 ** min(self.consecutiveNacks - 1, 16)
+        return min(Node.MAX_BACKOFF, backoff) * random.uniform(0.5, 1.0)
+    
+    # We promised the leader PREPARE of ballot for round r, which covers every round after it
+    # too. Only a higher ballot replaces the leader ballot we promised before
+    def promiseLeader(self, r, ballot):
+        if self.promisedBallot and ballot < self.promisedBallot:
+            return
+        
+        if self.promisedBallot:
+            self.promisedRound = min(self.promisedRound, r)
         else:
-            for i in xrange(self.highestRound, r):
-                self.setOfGaps.add(i)
-                self.highestRound = r+1
+            self.promisedRound = r
+        self.promisedBallot = ballot
+        if self.leaderBallot and ballot > self.leaderBallot:
+            self.logger.info('Stepping down as leader')
+            self.leaderBallot = None
+    
+    # Highest leader ballot we have promised for round r, or None
+    def promisedBallotFor(self, r):
+        if self.promisedBallot and r >= self.promisedRound:
+            return self.promisedBallot
+        return None
+    
+    # Highest round this node has any knowledge of
+    def getMaxRound(self):
+        maxRound = self.highestRound - 1
+        if self.paxosStates:
+            maxRound = max(maxRound, max(self.paxosStates))
+        return maxRound
     
-    # Returns a list of servers other than self that create a quorum
-    def getQuorum(self):
-        return random.sample(self.serverSet, self.quorumSize-1)
+    # Returns a list of servers other than self that create a quorum, along with our own
+    # vote unless ownVote is 0: the ones with the shortest round trips, leaving out any we
+    # suspect of being down if we can
+    def getQuorum(self, ownVote = 1):
+        servers = random.sample(self.serverSet, len(self.serverSet))
+        servers.sort(key = lambda server: (server in self.suspects, self.rtt.timeout(server)))
+        return servers[:self.quorumSize - ownVote]
+    
+    # Whether our own promise or acceptance counts towards the quorum of our proposal
+    # with state, as 1 or 0
+    def ownVote(self, state):
+        return 0 if state.metadata.get('refusedSelf') else 1
     
     # Serialize and send the given message msg to the given address addr
     def sendMessage(self, msg, addr):
         if self.hasFailed: 
             return
         
-        print '{0}: Sent a message to {1}'.format(self.addr, addr)
-        data = pickle.dumps(msg)
+        msg = self.attachCommits(msg, addr)
+        self.metrics.count('sent.' + TYPE_NAMES.get(msg.messageType, str(msg.messageType)))
+        self.logger.trace('Sent a message to {0}', addr)
+        data = codec.encode(msg, self.logger)
 #         time.sleep(random.uniform(0.0, 1.0))
-        self.socket.sendto(data, addr)
+        self.transport.send(data, addr)
+    
+    # Queue depths, read whenever the metrics are
+    def addGauges(self):
+        self.metrics.gauge('proposals.in-flight', lambda: len(self.completions))
+        self.metrics.gauge('proposals.backlog', lambda: len(self.backlog))
+        self.metrics.gauge('proposals.forwarded', lambda: len(self.forwarded))
+        self.metrics.gauge('rounds.states', lambda: len(self.paxosStates))
+        self.metrics.gauge('loop.ready', lambda: len(self.loop.ready))
+        self.metrics.gauge('loop.timers', lambda: len(self.loop.timers))
+        self.metrics.gauge('loop.timers-fired', lambda: self.loop.timersFired)
+        self.metrics.gauge('log.unsynced', lambda: len(self.log.unsynced))
+        self.metrics.gauge('log.applied-round', lambda: self.log.appliedRound)
+        self.metrics.gauge('sync.streams', lambda: len(self.sync.streams))
+        self.metrics.gauge('reads.pending', lambda: self.reads.pending())
+        self.metrics.gauge('commits.pending', lambda: len(self.commits))
+        if self.batcher:
+            self.metrics.gauge('batcher.pending', lambda: len(self.batcher.pending))
+    
+    def printStats(self):
+        print self.metrics.report()
     
-    def initSetOfGaps(self):
-        if not self.log.transactions: return
+    # The log folded every round below r into a snapshot. Drop our Paxos state for those
+    # rounds, and move any of our values still waiting on one of them to a fresh round
+    def compactStates(self, r):
+        for key in [key for key in self.paxosStates if key < r]:
+            del self.paxosStates[key]
+        for key in [key for key in self.timers if key < r]:
+            self.cancelTimers(key)
         
-        rounds_decided = sorted(iter(self.log.transactions))
-        self.highestRound = rounds_decided[-1] + 1
+        self.highestRound = max(self.highestRound, r)
         
-        self.setOfGaps |= Set(xrange(rounds_decided[0]))
-        for i in xrange(len(rounds_decided)-1):
-            self.setOfGaps |= Set(xrange(rounds_decided[i]+1, rounds_decided[i+1]))
+        for h, (round, value, forwarded) in self.proposals.items():
+            if round < r:
+                del self.proposals[h]
+                self.offered.pop(h, None)
+                if value[0] == Log.NOOP:
+                    continue
+                if h not in self.log.hashes:
+                    self.beginRound(value = value, forwarded = forwarded)
+                else:
+                    self.releaseDecided(h)
             
-    def logSync(self, log, addr = None, messageType = Message.LOG_SYNC_REQUEST):
-        log_msg = Message(None, 
-                          messageType,
-                          self.addr,
-                          None, 
-                          {'log': log})
-        
-        if addr:
-            self.sendMessage(log_msg, addr)
-        else:
-            for server in self.serverSet:
-                self.sendMessage(log_msg, server)
+    # Fetch the rounds we are missing from addr, or from the leader or a random peer
+    def logSync(self, addr = None):
+        self.sync.request(addr)
 
     # Stop all network activity
     def fail(self):
-        assert self.hasFailed != self.messagePump.isRunning
+        assert self.hasFailed != self.transport.isRunning
         
         if self.hasFailed:
-            print '{0}: Already failed'.format(self.addr)
+            self.logger.info('Already failed')
         
         else:
-            self.messagePump.isRunning = False
+            self.transport.isRunning = False
             self.hasFailed = True
-            print '{0}: Halting activity'.format(self.addr)
+            self.logger.info('Halting activity')
 
     # Resume network activity
     def unfail(self):
-        assert self.hasFailed != self.messagePump.isRunning
+        assert self.hasFailed != self.transport.isRunning
 
         if not self.hasFailed:
-            print '{0}: Already running'.format(self.addr)
+            self.logger.info('Already running')
         
         else:
-            self.messagePump.isRunning = True
+            self.transport.isRunning = True
             self.hasFailed = False
-            print '{0}: Resuming activity'.format(self.addr)
+            self.logger.info('Resuming activity')
 
 if __name__ == '__main__':
     n1 = Node('127.0.0.1', 55555, '127.0.0.1', 55555, '../config2')
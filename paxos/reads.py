@@ -0,0 +1,272 @@
+#!/usr/bin/python
+
+import random
+import threading
+from sets import Set
+from message import Message
+from log import Log
+
+class Read(object):
+    '''
+    A linearizable read of the log. query(log) runs on the node's loop once the log holds
+    every operation decided before the read was made, and its result is kept in value
+    before completed is set
+    '''
+
+    def __init__(self, query, completed = None):
+        self.query = query
+        self.completed = completed or threading.Event()
+        self.value = None
+        self.start = None
+
+        # Round the log must be applied up to before the query may run
+        self.index = None
+
+    def wait(self, timeout = None):
+        return self.completed.wait(timeout)
+
+class Reads(object):
+    '''
+    This class serves linearizable reads without running them through a Paxos round.
+
+    A stable leader holds a lease on its leadership. Every acceptor that accepts one of
+    its ACCEPTs or answers one of its read index requests grants it the lease for
+    DURATION seconds, during which the acceptor refuses PREPAREs and ACCEPTs of anyone
+    else. Counting from when it sent its message, and with DRIFT to spare for clocks
+    running at different speeds, the leader knows that nobody else can decide anything
+    while a quorum's grants last. So it answers reads from its own log as soon as the
+    log holds every round up to its read index: the end of its log, and of every round
+    decided before it was elected.
+
+    Without a lease, the read index comes from a quorum. Every peer answers a read index
+    request with the round after the highest one it knows of. Any decided round was
+    accepted by a quorum, which overlaps the one answering, so the largest answer covers
+    every operation decided before the request was sent. Reads wait for the next
+    request, which a leader uses to renew its lease as well.
+
+    Rounds below a read index that nobody decided are filled with a NOOP by the leader,
+    or by any node if there is no leader. Others fetch them from the leader, and only
+    propose NOOPs themselves once the leader did not help for SYNC_ATTEMPTS checks
+    '''
+
+    DURATION = 2.0
+    DRIFT    = 0.1
+    
+    SYNC_ATTEMPTS = 4
+
+    def __init__(self, node):
+        self.node = node
+        self.log = node.log
+
+        # Lease grants the leader holds, as peer -> (ballot, expiry), by our clock
+        self.grants = {}
+
+        # The lease this node granted as an acceptor: holder, its ballot and the expiry
+        self.holder = None
+        self.holderBallot = None
+        self.expiry = 0
+
+        # A restarted node may have granted a lease it no longer remembers. It keeps out of
+        # every election until any such lease has run out
+        self.quietUntil = 0
+
+        # Reads waiting for the log to reach their index, the outstanding read index request
+        # and the reads waiting for the next one
+        self.waiting = []
+        self.request = None
+        self.queued = []
+        self.timer = None
+        
+        # Checks in a row that found the log stuck below the index of a waiting read
+        self.stalled = 0
+        self.appliedRound = None
+
+    def start(self):
+        if self.log.endRound() > 0 and self.node.stableLeader:
+            self.quietUntil = self.node.loop.time() + Reads.DURATION
+
+    # Read from any thread. Returns the read, which is completed once its query ran
+    def read(self, query, completed = None):
+        read = Read(query, completed)
+        self.node.loop.callSoon(self.begin, read)
+        return read
+
+    def begin(self, read):
+        read.start = self.node.loop.time()
+
+        if self.hasLease():
+            self.node.metrics.count('reads.lease')
+            read.index = max(self.log.endRound(), self.node.leaderRound)
+            self.waiting.append(read)
+            if not self.request and self.leaseExpiry() - self.node.loop.time() < Reads.DURATION / 2:
+                self.sendRequest()
+        else:
+            self.node.metrics.count('reads.index')
+            self.queued.append(read)
+            if not self.request:
+                self.sendRequest()
+
+        self.serve()
+        self.schedule()
+
+    # Answer every read whose index the log has reached
+    def serve(self):
+        if not self.waiting:
+            return
+
+        waiting, self.waiting = self.waiting, []
+        for read in waiting:
+            if self.log.appliedRound < read.index:
+                self.waiting.append(read)
+                continue
+
+            self.node.metrics.observe('phase.read', self.node.loop.time() - read.start)
+            read.value = read.query(self.log)
+            read.completed.set()
+
+    # Ask every peer for its read index, which as leader renews our lease too
+    def sendRequest(self):
+        node = self.node
+        now = node.loop.time()
+        self.request = {'sent': now, 'replies': {}, 'reads': self.queued}
+        self.queued = []
+
+        if node.leaderBallot:
+            self.grant(node.addr, node.leaderBallot)
+        msg = Message(None, Message.READ_INDEX_REQUEST, node.addr, node.leaderBallot, {'sent': now})
+        for server in node.serverSet:
+            node.sendMessage(msg, server)
+
+        self.processReplies()
+
+    def processRequest(self, msg):
+        node = self.node
+        if node.loop.time() < self.quietUntil:
+            return
+
+        metadata = {'sent': msg.metadata['sent'], 'index': node.getMaxRound() + 1}
+        if msg.ballot and (not node.promisedBallot or msg.ballot >= node.promisedBallot) and self.mayGrant(msg.source):
+            self.grant(msg.source, msg.ballot)
+            metadata['lease'] = True
+
+        node.sendMessage(Message(None, Message.READ_INDEX_RESPONSE, node.addr, msg.ballot, metadata), msg.source)
+
+    def processResponse(self, msg):
+        if msg.metadata.get('lease'):
+            self.granted(msg.source, msg.ballot, msg.metadata['sent'])
+            self.serveLeaseReads()
+
+        if self.request and msg.metadata['sent'] == self.request['sent']:
+            self.request['replies'][msg.source] = msg.metadata['index']
+            self.processReplies()
+
+    # Once a quorum answered the request, its reads wait for the largest index
+    def processReplies(self):
+        node = self.node
+        replies = self.request['replies']
+        if len(replies) + 1 < node.quorumSize:
+            return
+
+        index = max(replies.values() + [node.getMaxRound() + 1])
+        for read in self.request['reads']:
+            read.index = index
+            self.waiting.append(read)
+        self.request = None
+
+        if self.queued:
+            self.sendRequest()
+        self.serve()
+
+    # Reads queued for a read index request can do without it once we hold a lease
+    def serveLeaseReads(self):
+        if not self.queued or not self.hasLease():
+            return
+
+        index = max(self.log.endRound(), self.node.leaderRound)
+        for read in self.queued:
+            read.index = index
+            self.waiting.append(read)
+        self.queued = []
+        self.serve()
+
+    # Check on the reads every quorum timeout until none are left
+    def schedule(self):
+        if self.timer or not (self.waiting or self.request or self.queued):
+            return
+        self.timer = self.node.loop.callLater(self.node.getQuorumTimeout(), self.check)
+
+    def check(self):
+        self.timer = None
+        node = self.node
+        self.serve()
+
+        # Ask again if a quorum did not answer in time
+        if self.request and node.loop.time() - self.request['sent'] >= node.getQuorumTimeout():
+            self.queued = self.request['reads'] + self.queued
+            self.sendRequest()
+
+        # Reads still waiting on a log that does not move need its gaps filled
+        if self.waiting and self.log.appliedRound == self.appliedRound:
+            self.stalled += 1
+            self.fillGaps(max(read.index for read in self.waiting))
+        else:
+            self.stalled = 0
+        self.appliedRound = self.log.appliedRound
+        self.schedule()
+
+    # Get the rounds below index that we miss decided, or fetch them from the leader
+    def fillGaps(self, index):
+        node = self.node
+        if node.leader and node.leader != node.addr and self.stalled <= Reads.SYNC_ATTEMPTS:
+            node.logSync(node.leader)
+            return
+
+        inFlight = Set(round for round, _, _ in node.proposals.itervalues())
+        r = self.log.firstGap()
+        while r < index:
+            if r not in inFlight:
+                node.beginRound(r, (Log.NOOP, 0.0, random.getrandbits(63)), forwarded = True)
+            r = self.log.nextGap(r + 1)
+
+    # Whether we are the leader and a quorum's grants of our lease still last
+    def hasLease(self):
+        return self.node.leaderBallot != None and self.leaseExpiry() > self.node.loop.time()
+
+    # Time our lease lasts until, the time the grant of the quorum-th peer runs out
+    def leaseExpiry(self):
+        node = self.node
+        needed = node.quorumSize - 1
+        if not needed:
+            return float('inf')
+
+        expiries = sorted((expiry for ballot, expiry in self.grants.itervalues() if ballot == node.leaderBallot),
+                          reverse = True)
+        if len(expiries) < needed:
+            return 0
+        return expiries[needed - 1]
+
+    # Peer granted us a lease for ballot, in answer to a message we sent at sent
+    def granted(self, peer, ballot, sent):
+        expiry = sent + Reads.DURATION * (1 - Reads.DRIFT)
+        if peer not in self.grants or self.grants[peer] < (ballot, expiry):
+            self.grants[peer] = (ballot, expiry)
+
+    # Whether source may be granted a lease, which it may unless another node holds one.
+    # Our own lease ends as soon as we step down as leader
+    def mayGrant(self, source):
+        if self.holder == None or self.holder == source or self.expiry <= self.node.loop.time():
+            return True
+        return self.holder == self.node.addr and self.node.leaderBallot != self.holderBallot
+
+    # Whether we refuse every PREPARE and ACCEPT of source, because we granted a lease to
+    # someone else or restarted too recently to know
+    def refuses(self, source):
+        return not self.mayGrant(source) or self.node.loop.time() < self.quietUntil
+
+    def pending(self):
+        return len(self.waiting) + len(self.queued) + (len(self.request['reads']) if self.request else 0)
+
+    def grant(self, source, ballot):
+        self.holder = source
+        self.holderBallot = ballot
+        self.expiry = self.node.loop.time() + Reads.DURATION
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+class RoundIndex(object):
+    '''
+    The decided rounds of a log with the balance change and the digest of each, kept in
+    Fenwick trees over the rounds from base onwards. Rounds can be added in any order, and
+    prefix sums, digests of ranges and the first missing round are found in O(log n)
+    '''
+
+    def __init__(self, base = 0, capacity = 1024):
+        self.base = base
+        self.entries = {}
+        self.rebuild(capacity)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, round):
+        return round in self.entries
+
+    # Mark round as decided with the given balance change. Digests of rounds are combined
+    # by xor, so two logs holding the same rounds have the same digest over any range
+    def add(self, round, delta, digest = 0):
+        if round < self.base or round in self.entries:
+            return
+
+        self.entries[round] = (delta, digest)
+        if round - self.base >= self.size:
+            self.rebuild(self.size * 2)
+            return
+
+        i = round - self.base + 1
+        while i <= self.size:
+            self.counts[i] += 1
+            self.sums[i] += delta
+            self.digests[i] ^= digest
+            i += i & -i
+
+    # Change the balance change of a decided round
+    def setDelta(self, round, delta):
+        if round not in self.entries:
+            return
+
+        old, digest = self.entries[round]
+        self.entries[round] = (delta, digest)
+        i = round - self.base + 1
+        while i <= self.size:
+            self.sums[i] += delta - old
+            i += i & -i
+
+    # Number of decided rounds, sum of their changes and their digest, over the rounds from
+    # base up to round
+    def prefix(self, round):
+        count, total, digest = 0, 0, 0
+        i = min(round - self.base + 1, self.size)
+        while i > 0:
+            count += self.counts[i]
+            total += self.sums[i]
+            digest ^= self.digests[i]
+            i -= i & -i
+        return count, total, digest
+
+    # Number of decided rounds and their digest, over the rounds from lo up to hi exclusive
+    def digest(self, lo, hi):
+        count, _, digest = self.prefix(hi - 1)
+        below, _, belowDigest = self.prefix(lo - 1)
+        return count - below, digest ^ belowDigest
+
+    # Smallest round from base onwards which is not decided
+    def firstGap(self):
+        pos = 0
+        step = self.highestStep()
+        while step:
+            if pos + step <= self.size and self.counts[pos + step] == step:
+                pos += step
+            step >>= 1
+        return self.base + pos
+
+    # The k-th decided round, counting from zero
+    def select(self, k):
+        pos = 0
+        step = self.highestStep()
+        while step:
+            if pos + step <= self.size and self.counts[pos + step] <= k:
+                pos += step
+                k -= self.counts[pos]
+            step >>= 1
+        return self.base + pos
+
+    # Smallest round from round onwards which is not decided
+    def nextGap(self, round):
+        round = max(round, self.base)
+        if round - self.base >= self.size:
+            return round
+
+        gaps = round - self.base - self.prefix(round - 1)[0]
+        pos = 0
+        step = self.highestStep()
+        while step:
+            if pos + step <= self.size and step - self.counts[pos + step] <= gaps:
+                pos += step
+                gaps -= step - self.counts[pos]
+            step >>= 1
+        return self.base + pos
+
+    # Highest decided round, or the round before base if there is none
+    def last(self):
+        if not self.entries:
+            return self.base - 1
+        return self.select(len(self.entries) - 1)
+
+    # Smallest decided round from round onwards, or None
+    def nextDecided(self, round):
+        k = self.prefix(max(round, self.base) - 1)[0]
+        if k >= len(self.entries):
+            return None
+        return self.select(k)
+
+    # Decided rounds between lo and hi inclusive, in order
+    def rounds(self, lo, hi):
+        first = self.prefix(lo - 1)[0]
+        last = self.prefix(hi)[0]
+        for k in xrange(first, last):
+            yield self.select(k)
+
+    # Forget every round below base
+    def rebase(self, base):
+        for round in [round for round in self.entries if round < base]:
+            del self.entries[round]
+        self.base = base
+        self.rebuild(1024)
+
+    def highestStep(self):
+        step = 1
+        while step * 2 <= self.size:
+            step *= 2
+        return step
+
+    # Lay the trees out again for at least capacity rounds, in linear time
+    def rebuild(self, capacity):
+        highest = max(self.entries) - self.base + 1 if self.entries else 0
+        self.size = capacity
+        while self.size < highest:
+            self.size *= 2
+
+        self.counts = [0] * (self.size + 1)
+        self.sums = [0] * (self.size + 1)
+        self.digests = [0] * (self.size + 1)
+        for round, (delta, digest) in self.entries.iteritems():
+            self.counts[round - self.base + 1] = 1
+            self.sums[round - self.base + 1] = delta
+            self.digests[round - self.base + 1] = digest
+
+        for i in xrange(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.counts[parent] += self.counts[i]
+                self.sums[parent] += self.sums[i]
+                self.digests[parent] ^= self.digests[i]
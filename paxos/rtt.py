@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+class RttEstimator(object):
+    '''
+    Round trip time estimates of every peer, kept the way TCP does (RFC 6298): a smoothed
+    round trip time and its mean deviation, from which a retransmission timeout follows.
+    Peers we have no sample of yet get INITIAL_TIMEOUT
+    '''
+
+    ALPHA = 1.0 / 8
+    BETA  = 1.0 / 4
+
+    INITIAL_TIMEOUT = 1.0
+    MIN_TIMEOUT     = 0.2
+    MAX_TIMEOUT     = 10.0
+
+    def __init__(self):
+        # Peer address -> (srtt, rttvar)
+        self.estimates = {}
+
+    # Account for a round trip of rtt seconds to peer
+    def sample(self, peer, rtt):
+        if rtt < 0:
+            return
+
+        if peer not in self.estimates:
+            self.estimates[peer] = (rtt, rtt / 2)
+            return
+
+        srtt, rttvar = self.estimates[peer]
+        rttvar = (1 - RttEstimator.BETA) * rttvar + RttEstimator.BETA * abs(srtt - rtt)
+        srtt = (1 - RttEstimator.ALPHA) * srtt + RttEstimator.ALPHA * rtt
+        self.estimates[peer] = (srtt, rttvar)
+
+    # Seconds to wait on an answer of peer
+    def timeout(self, peer):
+        if peer not in self.estimates:
+            return RttEstimator.INITIAL_TIMEOUT
+
+        srtt, rttvar = self.estimates[peer]
+        return min(RttEstimator.MAX_TIMEOUT, max(RttEstimator.MIN_TIMEOUT, srtt + 4 * rttvar))
+
+    # Seconds to wait on answers of count of the given peers, which is as long as the
+    # count-th fastest of them takes
+    def quorumTimeout(self, peers, count):
+        timeouts = sorted(self.timeout(peer) for peer in peers)
+        if not timeouts:
+            return RttEstimator.INITIAL_TIMEOUT
+        return timeouts[min(max(count, 1), len(timeouts)) - 1]
@@ -4,44 +4,193 @@
 Created on Dec 5, 2014
 
 @author: Karthik Puthraya
+
+Runs the shards of a server in several processes, so that a host uses all of its cores
+rather than the one a single Python process is held to. A router process owns the
+server's port and hands every message to the worker process hosting the shard it is
+prefixed with, and a supervisor restarts any process that dies. Workers send their
+messages straight to the peers, and keep what they promised and accepted as acceptors
+on disk, so a restarted worker keeps its word.
+
+    python run_node.py <local ip> <local port> <global ip> <global port> [config] --shards <n>
 '''
-from sys import argv, exit
-from os import kill, getpid
-from node import Node
-from time import sleep
+import sys
+import time
 import signal
+import socket
+import argparse
+import multiprocessing
+from eventloop import EventLoop
+from transport import UdpTransport
+from shard import ShardedNode
+from logger import Logger
+
+parser = argparse.ArgumentParser(description = 'Run the shards of a server in one process per core')
+parser.add_argument('localIP')
+parser.add_argument('localPort', type = int)
+parser.add_argument('globalIP')
+parser.add_argument('globalPort', type = int)
+parser.add_argument('config', nargs = '?', default = 'config')
+parser.add_argument('--shards', type = int, default = multiprocessing.cpu_count(),
+                    help = 'number of shards, which every server of the cluster must agree on (default the number of cores)')
+parser.add_argument('--workers', type = int, default = None,
+                    help = 'number of worker processes, each hosting every workers-th shard (default one per shard)')
+parser.add_argument('--worker-port', type = int, default = None,
+                    help = 'first local UDP port of the workers, one per worker (default any free ports)')
+parser.add_argument('--window', type = int, default = 1)
+parser.add_argument('--batch-size', type = int, default = 1)
+parser.add_argument('--batch-delay', type = int, default = 10)
+parser.add_argument('--flush-interval', type = int, default = 2)
+parser.add_argument('--flush-batch', type = int, default = 256)
+parser.add_argument('--snapshot-interval', type = int, default = 1000)
+parser.add_argument('--anti-entropy', type = float, default = 5)
+parser.add_argument('--thrifty', action = 'store_true')
+parser.add_argument('--allow-pickle', action = 'store_true')
+parser.add_argument('--log-level', type = Logger.getLevel, default = 'info')
+parser.add_argument('--stats-port', type = int, default = None,
+                    help = 'local UDP port of the metrics of the first shard, the port + i for shard i')
+
+# Forward every datagram on the server's port to the worker hosting the shard it is
+# prefixed with. Datagrams to a worker which is down or restarting are dropped, as the
+# network could have dropped them
+def route(addr, workers, workerAddrs, logLevel = Logger.INFO):
+    logger = Logger('router', logLevel)
+    logger.start()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(addr)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    logger.info('Routing messages on {0}:{1} to {2} workers', addr[0], addr[1], workers)
+
+    while True:
+        data = listener.recv(65535)
+        if not data:
+            continue
+
+        try:
+            sender.sendto(data, workerAddrs[ord(data[0]) % workers])
+        except socket.error:
+            pass
+
+# Run the given shards of the server, listening on the local workerAddr for the messages
+# the router hands over
+def work(options, hosted, workerAddr):
+    logger = Logger('{0}:{1}'.format(options.globalIP, options.globalPort), options.log_level)
+    logger.start()
+    loop = EventLoop(logger)
+    server = ShardedNode(options.shards, options.localIP, options.localPort, options.globalIP, options.globalPort,
+                         config = options.config, stableLeader = True, window = options.window,
+                         batchSize = options.batch_size, batchDelay = options.batch_delay,
+                         flushInterval = options.flush_interval, flushBatch = options.flush_batch,
+                         snapshotInterval = options.snapshot_interval, antiEntropyInterval = options.anti_entropy,
+                         logLevel = options.log_level, statsPort = options.stats_port, thrifty = options.thrifty,
+                         allowPickle = options.allow_pickle, loop = loop, transport = UdpTransport(loop, *workerAddr),
+                         hosted = hosted, logger = logger)
+    server.run()
+
+# Local addresses of the given number of workers, from port onwards or else on free ports.
+# A worker keeps its address when it is restarted
+def getWorkerAddrs(workers, port = None):
+    if port:
+        return [('127.0.0.1', port + i) for i in xrange(workers)]
+
+    sockets = []
+    for i in xrange(workers):
+        sockets.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+        sockets[-1].bind(('127.0.0.1', 0))
+    addrs = [sock.getsockname() for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return addrs
+
+# Run target(*args) in a child process. Signals are left to the supervisor, which stops
+# its children itself
+def runChild(target, *args):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(*args)
+
+class Supervisor(object):
+    '''
+    Starts the router and the workers and restarts any of them that exits. A process
+    which keeps dying is restarted after a delay that doubles up to MAX_RESTART_DELAY,
+    and runs for STABLE seconds before the delay is reset
+    '''
+
+    RESTART_DELAY = 0.5
+    MAX_RESTART_DELAY = 30
+    STABLE = 60
+
+    def __init__(self, logLevel = Logger.INFO):
+        # Target and arguments, process, start time and restart delay of every child, by name
+        self.children = {}
+        self.stopping = False
+        self.logger = Logger('supervisor', logLevel)
+        self.logger.start()
 
-def signal_handler(sig, frame):
-    print('You pressed Ctrl+C!')
-    kill(getpid(), signal.SIGTERM)
-    exit(0)
+    def add(self, name, target, *args):
+        self.children[name] = {'target': target, 'args': args, 'process': None, 'started': None,
+                               'delay': Supervisor.RESTART_DELAY, 'restartAt': 0}
+
+    def start(self, name):
+        child = self.children[name]
+        child['process'] = multiprocessing.Process(target = runChild, args = (child['target'],) + child['args'],
+                                                   name = name)
+        child['process'].daemon = True
+        child['process'].start()
+        child['started'] = time.time()
+
+    def run(self):
+        for name in sorted(self.children):
+            self.start(name)
+
+        while not self.stopping:
+            time.sleep(0.2)
+
+            for name, child in sorted(self.children.iteritems()):
+                process = child['process']
+                if process and process.is_alive():
+                    if time.time() - child['started'] > Supervisor.STABLE:
+                        child['delay'] = Supervisor.RESTART_DELAY
+                    continue
+
+                # Died just now. Restart it once its delay is over
+                if process:
+                    self.logger.warning('Process {0} exited with code {1}. Restarting in {2}s',
+                                        name, process.exitcode, child['delay'])
+                    child['process'] = None
+                    child['restartAt'] = time.time() + child['delay']
+                    child['delay'] = min(Supervisor.MAX_RESTART_DELAY, child['delay'] * 2)
+
+                elif time.time() >= child['restartAt']:
+                    self.start(name)
+
+    def stop(self):
+        self.stopping = True
+        for child in self.children.itervalues():
+            if child['process'] and child['process'].is_alive():
+                child['process'].terminate()
 
 if __name__ == '__main__':
+    options = parser.parse_args()
+    workers = min(options.workers or options.shards, options.shards)
+    workerAddrs = getWorkerAddrs(workers, options.worker_port)
+
+    supervisor = Supervisor(options.log_level)
+
+    def signal_handler(sig, frame):
+        supervisor.stop()
+        sys.exit(0)
+
     signal.signal(signal.SIGINT, signal_handler)
-    
-    if len(argv) == 3:
-        print 'Starting server at port {0}'.format(argv[2])
-        n = Node(argv[1], int(argv[2]))
-        n.start()
-        while True:
-            try: 
-                print n.paxosStates[0]
-            except:
-                pass
-            sleep(5)
-    elif len(argv) == 4:
-        print 'Starting server at port {0}'.format(argv[2])
-        n = Node(argv[1], int(argv[2]))
-        n.start()
-        print 'Starting Paxos with value {0}'.format(argv[3])
-        n.initPaxos(0, value = argv[3])
-        while True:
-            try: 
-                print n.paxosStates[0]
-            except:
-                pass
-            sleep(5)
-
-
-    
-    
\ No newline at end of file
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # A single shard needs no router, so its worker takes the server's port itself
+    if options.shards == 1:
+        supervisor.add('worker-0', work, options, [0], (options.localIP, options.localPort))
+    else:
+        supervisor.add('router', route, (options.localIP, options.localPort), workers, workerAddrs,
+                       options.log_level)
+        for i in xrange(workers):
+            supervisor.add('worker-{0}'.format(i), work, options, range(i, options.shards, workers), workerAddrs[i])
+
+    supervisor.run()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+import zlib
+import threading
+from node import Node
+from eventloop import EventLoop
+from transport import UdpTransport
+from transport import TcpTransport
+from logger import Logger
+
+# Shard of the given number of shards that an account belongs to. Operations without an
+# account all belong to the first shard
+def shardOf(account, shards):
+    if account == None or shards == 1:
+        return 0
+    return (zlib.crc32(str(account)) & 0xffffffff) % shards
+
+class ShardTransport(object):
+    '''
+    The transport of one shard of a ShardedNode. Its messages share the node's transport
+    with those of the other shards, prefixed by the number of the shard, which the node
+    looks at to hand every incoming message to the right shard
+    '''
+
+    def __init__(self, transport, shard):
+        self.transport = transport
+        self.prefix = chr(shard)
+        self.received = None
+        self.isRunning = True
+
+    def start(self, received):
+        self.received = received
+
+    def send(self, data, addr):
+        if self.isRunning:
+            self.transport.send(self.prefix + data, addr)
+
+class ShardedNode(threading.Thread):
+    '''
+    A server whose accounts are split into shards, each replicated by a Paxos group of
+    its own. A shard is a Node with its own rounds, leader, window and log, so operations
+    on accounts of different shards never wait on each other. All shards run on one event
+    loop and send their messages through one transport.
+
+    With a single shard, the node behaves exactly like a plain Node and keeps the same
+    log files and message format. Every server of the cluster must use the same number
+    of shards.
+
+    A process may host only some of the shards of a server, with the rest running in
+    other processes, as run_node.py does to use every core of a host
+    '''
+
+    # Shard numbers travel as a single byte
+    MAX_SHARDS = 256
+
+    def __init__(self, shards, localIP, localPort, globalIP, globalPort, statsPort = None, tcp = False,
+                 loop = None, transport = None, hosted = None, logger = None, **options):
+        '''
+        hosted lists the shards this process runs, by default all of them. Further options
+        are passed on to the Node of every shard. If statsPort is given, shard i answers
+        with its metrics on statsPort + i. The loop and transport the shards share report
+        to logger, by default one named after the server
+        '''
+        threading.Thread.__init__(self)
+        assert 1 <= shards <= ShardedNode.MAX_SHARDS
+
+        self.addr = (globalIP, globalPort)
+        if logger == None:
+            logger = Logger('{0}:{1}'.format(globalIP, globalPort), options.get('logLevel', Logger.INFO))
+            logger.start()
+        self.logger = logger
+        
+        self.loop = loop or EventLoop(self.logger)
+        if transport == None:
+            transport = (TcpTransport if tcp else UdpTransport)(self.loop, localIP, localPort, self.logger)
+        self.transport = transport
+
+        # Node of every hosted shard, in order and by shard number
+        self.shardCount = shards
+        self.nodes = []
+        self.shards = {}
+        for shard in (xrange(shards) if hosted == None else sorted(hosted)):
+            if shards == 1:
+                node = Node(localIP, localPort, globalIP, globalPort, statsPort = statsPort,
+                            loop = self.loop, transport = transport, **options)
+            else:
+                node = Node(localIP, localPort, globalIP, globalPort,
+                            statsPort = statsPort + shard if statsPort else None,
+                            loop = self.loop, transport = ShardTransport(transport, shard), shard = shard, **options)
+            self.nodes.append(node)
+            self.shards[shard] = node
+
+    def run(self):
+        self.startServices()
+        self.loop.run()
+
+    def startServices(self):
+        for node in self.nodes:
+            node.startServices()
+        if self.shardCount > 1:
+            self.transport.start(self.datagramReceived)
+
+    # Hand a message to the shard it is prefixed with
+    def datagramReceived(self, data, addr):
+        if not data or ord(data[0]) not in self.shards:
+            self.logger.error('Dropped a message from {0} for a shard we do not host', addr)
+            return
+
+        transport = self.shards[ord(data[0])].transport
+        if transport.isRunning:
+            transport.received(data[1:], addr)
+
+    # Node of the shard that account belongs to, or None if this process does not host it
+    def shardFor(self, account):
+        return self.shards.get(shardOf(account, self.shardCount))
+
+    # Node of the shard that the account of an operation, if it names one, belongs to
+    def shardForValue(self, value):
+        return self.shardFor(value[3] if len(value) > 3 else None)
+
+    # Submit an operation from any thread to its shard. Returns its completion event
+    def submit(self, value):
+        return self.shardForValue(value).submit(value)
+
+    def getAccountBalance(self, account):
+        return self.shardFor(account).log.getAccountBalance(account)
+
+    def fail(self):
+        for node in self.nodes:
+            node.fail()
+
+    def unfail(self):
+        for node in self.nodes:
+            node.unfail()
+
+    def logSync(self):
+        for node in self.nodes:
+            node.logSync()
+
+    def printStats(self):
+        for node in self.nodes:
+            if self.shardCount > 1:
+                print 'Shard {0}:'.format(node.shard)
+            node.printStats()
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+import heapq
+import random
+import threading
+from eventloop import EventLoop
+
+class SimulatedLoop(EventLoop):
+    '''
+    An event loop on a virtual clock, shared by every node of a simulation. Time stands
+    still while callbacks are ready to run and otherwise jumps straight to the next timer,
+    so seconds of protocol time pass in however long the callbacks take to run
+    '''
+
+    def __init__(self):
+        EventLoop.__init__(self)
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    # Run until stop is called, nothing is left to do, or the clock would pass until
+    def run(self, until = None):
+        self.thread = threading.current_thread()
+        self.running = True
+
+        while self.running:
+            if self.ready:
+                for _ in xrange(len(self.ready)):
+                    callback, args = self.ready.popleft()
+                    self.runCallback(callback, args)
+                continue
+
+            while self.timers and self.timers[0][2].cancelled:
+                heapq.heappop(self.timers)
+            if not self.timers:
+                break
+
+            when, _, handle = self.timers[0]
+            if until != None and when > until:
+                self.now = until
+                break
+
+            heapq.heappop(self.timers)
+            self.now = max(self.now, when)
+            self.timersFired += 1
+            self.runCallback(handle.callback, handle.args)
+
+class SimulatedNetwork(object):
+    '''
+    Delivers messages between SimulatedTransports on a SimulatedLoop. Each message takes
+    latency seconds give or take jitter, is lost with probability loss, and with
+    probability reorder is held back for up to another latency so that later messages
+    overtake it. Nodes in different partitions can't reach each other. All randomness
+    comes from seed, so a simulation can be repeated exactly
+    '''
+
+    # Largest UDP payload, beyond which a datagram could never be sent
+    MAX_DATAGRAM = 65507
+
+    def __init__(self, loop, latency = 0.001, jitter = 0, loss = 0, reorder = 0, seed = 0):
+        self.loop = loop
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+        self.transports = {}
+        self.groups = {}
+        self.delivered = 0
+        self.dropped = 0
+
+    def attach(self, transport):
+        self.transports[transport.addr] = transport
+
+    # Split the nodes into the given groups of addresses. Nodes left out of every group
+    # form one more group together
+    def partition(self, *groups):
+        self.groups = {}
+        for i, group in enumerate(groups):
+            for addr in group:
+                self.groups[addr] = i
+
+    def heal(self):
+        self.groups = {}
+
+    def canReach(self, source, addr):
+        return self.groups.get(source) == self.groups.get(addr)
+
+    def send(self, data, source, addr):
+        if len(data) > SimulatedNetwork.MAX_DATAGRAM or not self.canReach(source, addr):
+            self.dropped += 1
+            return
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        delay = max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        if self.reorder and self.random.random() < self.reorder:
+            delay += self.random.uniform(0, self.latency)
+        self.loop.callLater(delay, self.deliver, data, source, addr)
+
+    def deliver(self, data, source, addr):
+        transport = self.transports.get(addr)
+        if not transport or not transport.isRunning or not self.canReach(source, addr):
+            self.dropped += 1
+            return
+
+        self.delivered += 1
+        transport.received(data, source)
+
+class SimulatedTransport(object):
+    '''
+    The transport of a node on a SimulatedNetwork, with the interface of UdpTransport
+    '''
+
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+        self.received = None
+        self.isRunning = True
+        network.attach(self)
+
+    def start(self, received):
+        self.received = received
+
+    def send(self, data, addr):
+        if self.isRunning:
+            self.network.send(data, self.addr, addr)
+
+class SimulatedCommit(object):
+    '''
+    Stands in for a GroupCommit of a simulated node's log. Records are written
+    without an fsync and their callbacks run right away, so that no other thread
+    hands work to the loop and the simulation stays deterministic
+    '''
+
+    def __init__(self, wal):
+        self.wal = wal
+        self.lock = threading.Lock()
+
+    def append(self, record, callback = None):
+        with self.lock:
+            self.wal.append(record)
+        if callback:
+            callback()
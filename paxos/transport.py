@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+import errno
+import struct
+import socket
+import collections
+from messagepump import MessagePump
+
+class UdpTransport(object):
+    '''
+    Carries a node's messages as UDP datagrams. Incoming datagrams are read by a
+    MessagePump on the node's event loop.
+
+    Every transport has the same interface: start(received) begins calling
+    received(data, addr) on the loop for every incoming message, send(data, addr) sends
+    one, and messages are neither sent nor received while isRunning is false
+    '''
+
+    def __init__(self, loop, ip, port, logger = None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.pump = MessagePump(loop, self.datagramReceived, ip = ip, port = port, logger = logger)
+        self.received = None
+        self.isRunning = True
+
+    def start(self, received):
+        self.received = received
+        self.pump.start()
+
+    def send(self, data, addr):
+        if self.isRunning:
+            self.socket.sendto(data, addr)
+
+    def datagramReceived(self, data, addr):
+        if self.isRunning:
+            self.received(data, addr)
+
+class TcpConnection(object):
+    '''
+    A connection to or from a peer. Outgoing frames wait in a buffer until the socket
+    takes them, and incoming bytes wait until they make up a whole frame
+    '''
+
+    def __init__(self, sock, addr, connected):
+        self.socket = sock
+        self.addr = addr
+        self.connected = connected
+        self.closed = False
+
+        # Frames to send, and how much of the first one is sent already
+        self.frames = collections.deque()
+        self.offset = 0
+        self.buffered = 0
+
+        self.incoming = ''
+
+class TcpTransport(object):
+    '''
+    Carries a node's messages over TCP, with the interface of UdpTransport. Each message
+    is framed by its length. The node keeps one persistent connection to every peer it
+    sends to and pipelines its messages over it, while peers' connections to the node
+    only carry messages the other way.
+
+    A connection that fails is opened again after a delay that doubles up to
+    MAX_RECONNECT_DELAY. Messages sent meanwhile are buffered, up to MAX_BUFFER bytes per
+    peer. Beyond that they are dropped, as a datagram would be, and the protocol's
+    timeouts take over
+    '''
+
+    LENGTH = struct.Struct('!I')
+
+    # Largest frame accepted from a peer. Anything larger means the stream is corrupt
+    MAX_FRAME = 16 * 1024 * 1024
+
+    MAX_BUFFER = 4 * 1024 * 1024
+
+    RECONNECT_DELAY = 0.1
+    MAX_RECONNECT_DELAY = 5.0
+
+    def __init__(self, loop, ip, port, logger = None):
+        self.loop = loop
+        self.logger = logger or loop.logger
+        self.addr = (ip, port)
+        self.listener = None
+        self.received = None
+        self.isRunning = True
+
+        # Outgoing connection and reconnect delay of every peer, keyed by its address
+        self.connections = {}
+        self.delays = {}
+
+    def start(self, received):
+        self.received = received
+        self.logger.info('Listening for TCP connections on {0}:{1}', *self.addr)
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.addr)
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.loop.addReader(self.listener, self.accept)
+
+    def send(self, data, addr):
+        if not self.isRunning:
+            return
+
+        connection = self.connections.get(addr)
+        if connection == None:
+            connection = self.connect(addr)
+
+        frame = TcpTransport.LENGTH.pack(len(data)) + data
+        if connection.buffered + len(frame) > TcpTransport.MAX_BUFFER:
+            return
+        connection.frames.append(frame)
+        connection.buffered += len(frame)
+
+        if connection.connected:
+            self.flush(connection)
+
+    def connect(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+
+        connection = TcpConnection(sock, addr, False)
+        self.connections[addr] = connection
+
+        error = sock.connect_ex(addr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.failed(connection)
+            return connection
+
+        self.loop.addWriter(sock, lambda: self.connected(connection))
+        return connection
+
+    # The outgoing connection finished connecting, or failed to
+    def connected(self, connection):
+        self.loop.removeWriter(connection.socket)
+        if connection.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self.failed(connection)
+            return
+
+        connection.connected = True
+        self.delays.pop(connection.addr, None)
+
+        # Replies to our messages come back over the peer's own connection, so this one is
+        # only read to notice that it closed
+        self.loop.addReader(connection.socket, lambda: self.readable(connection))
+        self.flush(connection)
+
+    # Write as much of the buffered frames as the socket takes
+    def flush(self, connection):
+        while connection.frames:
+            frame = connection.frames[0]
+            try:
+                sent = connection.socket.send(frame[connection.offset:])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.failed(connection)
+                return
+
+            connection.offset += sent
+            if connection.offset < len(frame):
+                break
+            connection.frames.popleft()
+            connection.buffered -= len(frame)
+            connection.offset = 0
+
+        if connection.frames:
+            self.loop.addWriter(connection.socket, lambda: self.flush(connection))
+        else:
+            self.loop.removeWriter(connection.socket)
+
+    # Close a failed outgoing connection and open a new one after a while. Buffered frames
+    # carry over, except one that was partly sent, which the peer could not make sense of
+    def failed(self, connection):
+        if connection.closed:
+            return
+        self.close(connection)
+
+        if connection.offset:
+            connection.buffered -= len(connection.frames.popleft())
+            connection.offset = 0
+
+        delay = self.delays.get(connection.addr, TcpTransport.RECONNECT_DELAY)
+        self.delays[connection.addr] = min(TcpTransport.MAX_RECONNECT_DELAY, delay * 2)
+        self.loop.callLater(delay, self.reconnect, connection)
+
+    def reconnect(self, connection):
+        if self.connections.get(connection.addr) is not connection:
+            return
+
+        fresh = self.connect(connection.addr)
+        if fresh is not connection:
+            fresh.frames, fresh.buffered = connection.frames, connection.buffered
+
+    def close(self, connection):
+        connection.closed = True
+        connection.connected = False
+        self.loop.removeReader(connection.socket)
+        self.loop.removeWriter(connection.socket)
+        connection.socket.close()
+
+    def accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            sock.setblocking(False)
+            connection = TcpConnection(sock, addr, True)
+            self.loop.addReader(sock, lambda connection = connection: self.readable(connection))
+
+    # Read what the peer sent and hand every whole frame to the node
+    def readable(self, connection):
+        closed = False
+        while True:
+            try:
+                data = connection.socket.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                data = ''
+
+            if not data:
+                closed = True
+                break
+            connection.incoming += data
+
+        # Frames which arrived before the peer hung up are still delivered
+        while len(connection.incoming) >= TcpTransport.LENGTH.size:
+            length = TcpTransport.LENGTH.unpack_from(connection.incoming)[0]
+            if length > TcpTransport.MAX_FRAME:
+                self.close(connection)
+                return
+
+            end = TcpTransport.LENGTH.size + length
+            if len(connection.incoming) < end:
+                break
+            frame = connection.incoming[TcpTransport.LENGTH.size:end]
+            connection.incoming = connection.incoming[end:]
+
+            if self.isRunning:
+                self.received(frame, connection.addr)
+
+        if closed:
+            if connection is self.connections.get(connection.addr):
+                self.failed(connection)
+            else:
+                self.close(connection)
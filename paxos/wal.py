@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+import os
+import struct
+import pickle
+import zlib
+import threading
+import time
+from collector import Collector
+from logger import Logger
+
+class WriteAheadLog():
+    '''
+    An append-only log of records split across segment files. Every record is framed
+    by its length and a CRC32 of its payload, so a torn write at the tail is detected
+    and dropped on replay
+    '''
+
+    HEADER = struct.Struct('!II')
+    SEGMENT_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, directory, segmentSize = SEGMENT_SIZE, logger = None):
+        # Reports go to the logger of the log, or to one of its own
+        if logger == None:
+            logger = Logger('wal')
+            logger.start()
+        self.logger = logger
+        
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.file = None
+        self.segment = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        segments = self.segments()
+        if segments:
+            self.segment = segments[-1]
+
+    # Indices of the segment files on disk, in order
+    def segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg'):
+                segments.append(int(name[:-4]))
+        return sorted(segments)
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, '{0:08d}.seg'.format(segment))
+
+    def isEmpty(self):
+        for segment in self.segments():
+            if os.path.getsize(self.segmentPath(segment)) > 0:
+                return False
+        return True
+
+    # Append one record to the current segment, rolling over to a new one when it is full.
+    # The record is only durable after the next sync
+    def append(self, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        frame = WriteAheadLog.HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+        if self.file == None:
+            self.openSegment()
+
+        if self.file.tell() > 0 and self.file.tell() + len(frame) > self.segmentSize:
+            self.sync()
+            self.file.close()
+            self.segment += 1
+            self.openSegment()
+
+        self.file.write(frame)
+
+    def openSegment(self):
+        created = not os.path.exists(self.segmentPath(self.segment))
+        self.file = open(self.segmentPath(self.segment), 'ab')
+
+        # Make the new directory entry durable too
+        if created:
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    # Flush everything appended so far and fsync it to disk
+    def sync(self):
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    # Yield every intact record, oldest first. A damaged record ends its segment, and
+    # if it is in the last segment the damaged tail is cut off so new appends follow
+    # the last good record
+    def replay(self):
+        segments = self.segments()
+        for segment in segments:
+            path = self.segmentPath(segment)
+            with open(path, 'rb') as file:
+                good = 0
+                while True:
+                    header = file.read(WriteAheadLog.HEADER.size)
+                    if len(header) < WriteAheadLog.HEADER.size:
+                        break
+
+                    length, checksum = WriteAheadLog.HEADER.unpack(header)
+                    payload = file.read(length)
+                    if len(payload) < length or zlib.crc32(payload) & 0xffffffff != checksum:
+                        self.logger.warning('Dropping damaged record in \'{0}\' at offset {1}', path, good)
+                        break
+
+                    good = file.tell()
+                    yield pickle.loads(payload)
+
+            if segment == segments[-1] and good < os.path.getsize(path):
+                with open(path, 'r+b') as file:
+                    file.truncate(good)
+
+    # Start a new segment holding only the given records, then delete every older segment
+    def compact(self, records):
+        self.sync()
+        self.close()
+
+        old = self.segments()
+        if old:
+            self.segment = old[-1] + 1
+
+        for record in records:
+            self.append(record)
+        if self.file == None:
+            self.openSegment()
+        self.sync()
+
+        for segment in old:
+            os.remove(self.segmentPath(segment))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    # Give up on the current segment after a failed write, which may have left a torn record
+    # at its tail. Replay stops that segment at the torn record and carries on with the
+    # next, where later appends go
+    def abandonSegment(self):
+        if self.file:
+            try:
+                self.file.close()
+            except (IOError, OSError):
+                pass
+            self.file = None
+            self.segment += 1
+
+class GroupCommit(Collector):
+    '''
+    This class writes records to a WriteAheadLog from its own thread. Records that arrive
+    close together share one fsync, and each record's callback runs once it is durable.
+    A group that fails to be written is retried, after RETRY_DELAY seconds doubling up to
+    MAX_RETRY_DELAY, so that no record is lost while the disk is out of space or failing
+    '''
+
+    RETRY_DELAY = 0.1
+    MAX_RETRY_DELAY = 5
+
+    def __init__(self, wal, flushInterval = 2, maxBatch = 256):
+        '''
+        A group is synced once it holds maxBatch records, or flushInterval milliseconds
+        after its first record arrived, whichever comes first
+        '''
+        Collector.__init__(self, maxBatch, flushInterval / 1000.0)
+        self.wal = wal
+
+        # Held while writing, so that others can safely compact the log in between groups
+        self.lock = threading.Lock()
+
+    # Queue a record. callback is called from this thread once the record is on disk
+    def append(self, record, callback = None):
+        self.add((record, callback))
+
+    # Write a group until it is durable, then run its callbacks. Later groups wait meanwhile,
+    # so records reach the disk in order
+    def flush(self, group):
+        delay = GroupCommit.RETRY_DELAY
+        while not self.write(group):
+            time.sleep(delay)
+            delay = min(GroupCommit.MAX_RETRY_DELAY, delay * 2)
+
+        for _, callback in group:
+            if callback:
+                callback()
+
+    # Append and fsync the records of a group. Returns whether they are durable
+    def write(self, group):
+        with self.lock:
+            try:
+                for record, _ in group:
+                    self.wal.append(record)
+                self.wal.sync()
+                return True
+
+            except Exception as e:
+                self.wal.logger.error('Could not write {0} records to the log, retrying: {1!r}', len(group), e)
+                self.wal.abandonSegment()
+                return False